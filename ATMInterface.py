@@ -1,17 +1,47 @@
 import tkinter as tk
-from tkinter import simpledialog
+from tkinter import simpledialog, filedialog
 import random
 import time
+import os
+import json
+import hashlib
+import threading
+import queue
+from collections import OrderedDict
+import traceback
 import pymongo
 from PIL import Image, ImageTk, ImageDraw
-
-# MongoDB setup
-client = pymongo.MongoClient("mongodb://localhost:27017/")
-db = client["atm_system"]
-accounts_collection = db["accounts"]
+from atm_engine import ATMEngine, parse_date_range
+from atm_connection import MongoConnectionManager, DEGRADED, OFFLINE, STARTING, UNAVAILABLE
+from atm_ledger import to_cents, format_cents
+from atm_outbox import OfflineOutbox, OutboxSyncer, OUTBOX_FILE
+
+# MongoDB setup (lazy: nothing touches the network until connection.start() or the first query)
+connection = MongoConnectionManager.from_env()
+db = connection.database()
+engine = ATMEngine(db)
+
+# Local journal that keeps deposits and withdrawals going while the bank is unreachable.
+# It is a file on the kiosk's disk, so it is opened when the kiosk starts, not on import.
+outbox = None
+syncer = None
+
+CONNECTION_POLL_MS = 250
+STATUS_BANNER_TEXT = {
+    DEGRADED: "Slow connection to the bank",
+    OFFLINE: "Offline: deposits and withdrawals only",
+    STARTING: "Connecting to the bank: deposits and withdrawals only",
+}
+
+# Background asset paths
+BACKGROUND_IMAGE_FILE = "currency.jpg"
+ASSET_CACHE_DIR = ".atm_cache"
 
 # --- Custom Toggle Switch Widget ---
 class ToggleSwitch(tk.Canvas):
+    ANIMATION_STEPS = 6
+    ANIMATION_FRAME_MS = 15
+
     def __init__(self, master, on_toggle_callback, initial_state=False, **kwargs):
         super().__init__(master, **kwargs)
         self.on_toggle_callback = on_toggle_callback
@@ -33,33 +63,359 @@ class ToggleSwitch(tk.Canvas):
         # We'll handle this from the ATMInterface side for better integration.
         
         self.bind("<Button-1>", self._toggle)
-        self.draw_switch()
+        self._anim_id = None
+        self.slider_x = self.slider_x_on if self.state else self.slider_x_off
 
-    def draw_switch(self):
-        self.delete("all")
-        
-        # Draw the background of the switch (the track)
-        # This is where the background color logic should be
-        track_color = "#00e676" if self.state else "#cccccc"
-        
+        # The canvas items are created once; toggling only recolors and moves them
+        track_color = self._track_color()
         # Rounded rectangle for the track
         # Draw two circles at the ends and a rectangle in the middle
-        self.create_oval(2, 2, self.height-2, self.height-2, fill=track_color, outline="") # Left half circle
-        self.create_oval(self.width-(self.height-2), 2, self.width-2, self.height-2, fill=track_color, outline="") # Right half circle
-        self.create_rectangle(self.height/2, 2, self.width-self.height/2, self.height-2, fill=track_color, outline="") # Middle rectangle
-        
+        self.create_oval(2, 2, self.height-2, self.height-2, fill=track_color, outline="", tags="track") # Left half circle
+        self.create_oval(self.width-(self.height-2), 2, self.width-2, self.height-2, fill=track_color, outline="", tags="track") # Right half circle
+        self.create_rectangle(self.height/2, 2, self.width-self.height/2, self.height-2, fill=track_color, outline="", tags="track") # Middle rectangle
+
         # Slider (white circle)
-        slider_x = self.slider_x_on if self.state else self.slider_x_off
-        self.create_oval(slider_x - self.slider_radius, self.height/2 - self.slider_radius,
-                         slider_x + self.slider_radius, self.height/2 + self.slider_radius,
-                         fill="white", outline="#cccccc", width=1)
+        self.slider = self.create_oval(0, 0, 0, 0, fill="white", outline="#cccccc", width=1)
+        self.draw_switch()
 
-    def _toggle(self, event=None):
-        self.state = not self.state
+    def _track_color(self):
+        return "#00e676" if self.state else "#cccccc"
+
+    def draw_switch(self):
+        self.itemconfig("track", fill=self._track_color())
+        self.coords(self.slider, self.slider_x - self.slider_radius, self.height/2 - self.slider_radius,
+                    self.slider_x + self.slider_radius, self.height/2 + self.slider_radius)
+
+    def set_state(self, state, animate=True):
+        self.state = state
+        if self._anim_id:
+            self.after_cancel(self._anim_id)
+            self._anim_id = None
+        target_x = self.slider_x_on if state else self.slider_x_off
+        if animate:
+            self._animate_to(target_x, self.ANIMATION_STEPS)
+        else:
+            self.slider_x = target_x
+            self.draw_switch()
+
+    def _animate_to(self, target_x, steps_left):
+        self.slider_x += (target_x - self.slider_x) / steps_left
         self.draw_switch()
+        if steps_left > 1:
+            self._anim_id = self.after(self.ANIMATION_FRAME_MS, self._animate_to, target_x, steps_left - 1)
+        else:
+            self._anim_id = None
+
+    def _toggle(self, event=None):
+        self.set_state(not self.state)
         if self.on_toggle_callback:
             self.on_toggle_callback()
 
+# --- Theme Engine ---
+THEMES = {
+    "light": {"bg": "#e0e0e0", # Light grey
+              "fg": "#0d47a1", "button_bg": "#1976d2", "button_fg": "white", "active_button_bg": "#1565c0"},
+    "dark": {"bg": "#2b2b2b", "fg": "white", "button_bg": "#555555", "button_fg": "white", "active_button_bg": "#777777"},
+}
+
+class ThemeEngine:
+    # Widgets register once under a role; switching themes recolors every registered
+    # widget with a single config() call in one pass, without rebuilding any screen.
+    ROLE_OPTIONS = {
+        "frame": lambda c: {"bg": c["bg"]},
+        "label": lambda c: {"bg": c["bg"], "fg": c["fg"]},
+        "message": lambda c: {"bg": c["bg"]}, # fg is chosen per message
+        "button": lambda c: {"bg": c["button_bg"], "fg": c["button_fg"], "activebackground": c["active_button_bg"]},
+        "list": lambda c: {"bg": c["bg"], "fg": c["fg"], "highlightbackground": c["bg"]},
+    }
+    WIDGET_ROLES = ((tk.Button, "button"), (tk.Label, "label"), (tk.Frame, "frame"), (tk.Listbox, "list"))
+
+    def __init__(self, themes, name):
+        self.themes = themes
+        self.name = name
+        self.colors = themes[name]
+        self._widgets = {} # widget -> role
+
+    def register(self, widget, role):
+        self._widgets[widget] = role
+        widget.config(**self.ROLE_OPTIONS[role](self.colors))
+        return widget
+
+    def register_tree(self, root):
+        # Registers root and its descendants by widget class; explicit registrations win
+        pending = [root]
+        while pending:
+            widget = pending.pop()
+            pending.extend(widget.winfo_children())
+            if widget in self._widgets:
+                continue
+            for widget_class, role in self.WIDGET_ROLES:
+                if isinstance(widget, widget_class):
+                    self.register(widget, role)
+                    break
+
+    def apply(self, name):
+        self.name = name
+        self.colors = self.themes[name]
+        options = {role: build(self.colors) for role, build in self.ROLE_OPTIONS.items()}
+        for widget, role in list(self._widgets.items()):
+            try:
+                widget.config(**options[role])
+            except tk.TclError: # Widget was destroyed
+                del self._widgets[widget]
+
+
+# --- Pre-scaled Background Asset Cache ---
+class BackgroundAssetCache:
+    # Decodes the source once into a mipmap pyramid stored under ASSET_CACHE_DIR/<sha256>/,
+    # so later launches and resizes resample from the closest small variant instead.
+    MAX_LEVEL_SIZE = 2048 # Cap on the largest stored variant (longest side)
+    MIN_LEVEL_SIZE = 128
+    MANIFEST_FILE = "manifest.json" # Written after the last level, so its presence means the pyramid is complete
+    VARIANT_QUALITY = 90 # JPEG variants decode several times faster than lossless PNG copies of a photo
+
+    def __init__(self, image_path, cache_dir=ASSET_CACHE_DIR):
+        self.image_path = image_path
+        self.cache_dir = os.path.join(cache_dir, self.file_hash(image_path))
+        self._images = {} # (width, height) -> decoded PIL image
+        self._lock = threading.Lock()
+
+        self.sizes = self._load_index()
+        if not self.sizes:
+            self.sizes = self._build_pyramid()
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _variant_path(self, size):
+        return os.path.join(self.cache_dir, f"{size[0]}x{size[1]}.jpg")
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dir, self.MANIFEST_FILE)
+
+    def _load_index(self):
+        # Trust the cache only if the manifest exists, was built with the current level limits
+        # and every variant it lists is still on disk at its recorded size; otherwise rebuild
+        try:
+            with open(self._manifest_path(), 'r') as f:
+                manifest = json.load(f)
+            if (manifest["max_level_size"], manifest["min_level_size"], manifest["quality"]) != \
+                    (self.MAX_LEVEL_SIZE, self.MIN_LEVEL_SIZE, self.VARIANT_QUALITY):
+                return []
+            sizes = []
+            for level in manifest["levels"]:
+                size = tuple(level["size"])
+                if os.path.getsize(self._variant_path(size)) != level["bytes"]:
+                    return []
+                sizes.append(size)
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+        return sorted(sizes)
+
+    def _write_manifest(self, sizes):
+        try:
+            levels = [{"size": list(size), "bytes": os.path.getsize(self._variant_path(size))} for size in sizes]
+            with open(self._manifest_path() + ".tmp", 'w') as f:
+                json.dump({"max_level_size": self.MAX_LEVEL_SIZE, "min_level_size": self.MIN_LEVEL_SIZE,
+                           "quality": self.VARIANT_QUALITY, "levels": levels}, f)
+            os.replace(self._manifest_path() + ".tmp", self._manifest_path())
+        except OSError as e:
+            print(f"Warning: could not write asset cache manifest: {e}")
+
+    def _build_pyramid(self):
+        image = Image.open(self.image_path)
+        # For JPEGs, draft() lets the decoder scale down by 1/2..1/8 while decoding
+        image.draft("RGB", (self.MAX_LEVEL_SIZE, self.MAX_LEVEL_SIZE))
+        image = image.convert("RGB")
+        image.thumbnail((self.MAX_LEVEL_SIZE, self.MAX_LEVEL_SIZE), Image.LANCZOS)
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Warning: could not create asset cache {self.cache_dir}: {e}")
+
+        try:
+            # Invalidate first: a run interrupted from here on leaves no manifest behind
+            os.remove(self._manifest_path())
+        except OSError:
+            pass
+        for name in os.listdir(self.cache_dir) if os.path.isdir(self.cache_dir) else []:
+            if name.endswith(".png"): # Lossless variants from older versions of the cache
+                os.remove(os.path.join(self.cache_dir, name))
+
+        sizes = []
+        written = True
+        level = image
+        while True:
+            sizes.append(level.size)
+            self._images[level.size] = level
+            path = self._variant_path(level.size)
+            try:
+                # Write then rename so a crash never leaves a truncated variant behind
+                level.save(path + ".tmp", format="JPEG", quality=self.VARIANT_QUALITY)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                written = False
+                print(f"Warning: could not write cached variant {level.size}: {e}")
+            if max(level.size) // 2 < self.MIN_LEVEL_SIZE:
+                break
+            # Each level is built from the previous one, not the full-size source
+            level = level.resize((max(1, level.width // 2), max(1, level.height // 2)), Image.LANCZOS)
+        if written:
+            self._write_manifest(sizes)
+        return sorted(sizes)
+
+    def variant_size_for(self, width, height):
+        # Smallest variant that still covers the target, so we only ever downsample
+        for size in self.sizes:
+            if size[0] >= width and size[1] >= height:
+                return size
+        return self.sizes[-1]
+
+    def image_for(self, width, height):
+        size = self.variant_size_for(width, height)
+        with self._lock:
+            image = self._images.get(size)
+            if image is None:
+                try:
+                    image = Image.open(self._variant_path(size))
+                    image.load()
+                except OSError as e:
+                    # Variant damaged on disk since the manifest was written; every level is kept in memory after this
+                    print(f"Warning: cached variant {size} is unreadable, rebuilding: {e}")
+                    self.sizes = self._build_pyramid()
+                    return self._images[self.variant_size_for(width, height)]
+                self._images[size] = image
+            return image
+
+    def smallest(self):
+        return self.image_for(0, 0)
+
+
+# --- Background Image Resize Pipeline ---
+class BackgroundResizer:
+    # Debounces <Configure> storms: a cheap preview is shown at most every preview_ms, the
+    # LANCZOS resample runs on a worker thread, and rendered sizes are kept in an LRU cache.
+    PREVIEW_MAX_SIZE = (320, 320)
+
+    def __init__(self, master, assets, on_ready, debounce_ms=150, preview_ms=100, cache_size=8, poll_ms=30):
+        self.master = master
+        self.assets = assets
+        self.on_ready = on_ready
+        self.debounce_ms = debounce_ms
+        self.preview_ms = preview_ms
+        self.cache_size = cache_size
+        self.poll_ms = poll_ms
+
+        self.cache = OrderedDict() # (width, height) -> ImageTk.PhotoImage
+        self.preview_image = assets.smallest().copy()
+        self.preview_image.thumbnail(self.PREVIEW_MAX_SIZE, Image.BILINEAR)
+
+        self._generation = 0
+        self._last_preview = 0.0
+        self._debounce_id = None
+        self._poll_id = None
+        self._in_flight = 0
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._worker = threading.Thread(target=self._worker_loop, daemon=True)
+        self._worker.start()
+
+    def request(self, width, height):
+        size = (max(1, int(width)), max(1, int(height)))
+        self._generation += 1 # Any render still in flight is for an older size
+        if self._debounce_id:
+            self.master.after_cancel(self._debounce_id)
+            self._debounce_id = None
+
+        cached = self.cache.get(size)
+        if cached is not None:
+            self.cache.move_to_end(size)
+            self.on_ready(cached)
+            return
+
+        # Between previews the last photo stays up; NEAREST keeps each one to a few ms on the
+        # Tk thread, and the real resample happens once the window settles
+        now = time.monotonic()
+        if (now - self._last_preview) * 1000 >= self.preview_ms:
+            self._last_preview = now
+            self.on_ready(ImageTk.PhotoImage(self.preview_image.resize(size, Image.NEAREST)))
+        self._debounce_id = self.master.after(self.debounce_ms, self._start_render, size)
+
+    def _start_render(self, size):
+        self._debounce_id = None
+        self._in_flight += 1
+        self._jobs.put((self._generation, size))
+        if not self._poll_id:
+            self._poll_id = self.master.after(self.poll_ms, self._poll_results)
+
+    def _worker_loop(self):
+        while True:
+            generation, size = self._jobs.get()
+            image = None
+            if generation == self._generation: # Skip sizes the user has already dragged past
+                try:
+                    source = self.assets.image_for(*size)
+                    image = source.resize(size, Image.LANCZOS)
+                except Exception as e:
+                    print(f"Error: background resize to {size} failed: {e}")
+            self._results.put((generation, size, image))
+
+    def _poll_results(self):
+        self._poll_id = None
+        while True:
+            try:
+                generation, size, image = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._in_flight -= 1
+            if image is None:
+                continue
+            # PhotoImage must be created on the Tk thread
+            photo = ImageTk.PhotoImage(image)
+            self.cache[size] = photo
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            if generation == self._generation:
+                self.on_ready(photo)
+
+        if self._in_flight > 0:
+            self._poll_id = self.master.after(self.poll_ms, self._poll_results)
+
+
+# --- Screen Manager ---
+class ScreenManager:
+    # Each screen is built once into its own frame, all stacked in the same grid cell.
+    # Switching screens raises the frame and runs its refresh hook for data-bound widgets.
+    def __init__(self, container, on_build=None):
+        self.container = container
+        self.on_build = on_build
+        self.container.grid_rowconfigure(0, weight=1)
+        self.container.grid_columnconfigure(0, weight=1)
+        self.screens = {} # name -> (frame, refresh)
+        self.current = None
+
+    def show(self, name, build, refresh=None, **frame_options):
+        if name not in self.screens:
+            frame = tk.Frame(self.container, **frame_options)
+            frame.grid(row=0, column=0, sticky="nsew")
+            build(frame)
+            if self.on_build:
+                self.on_build(frame)
+            self.screens[name] = (frame, refresh)
+        frame, refresh = self.screens[name]
+        if refresh:
+            refresh()
+        frame.tkraise()
+        self.current = name
+        return frame
+
+
 # --- ATM Interface Class ---
 class ATMInterface:
     def __init__(self, master):
@@ -69,15 +425,20 @@ class ATMInterface:
         self.master.minsize(600, 600)
 
         self.dark_mode = False
+        self.theme = ThemeEngine(THEMES, "light")
         self.set_colors()
 
         self.current_user = None
 
-        self.original_bg_image = None
+        self.bg_assets = None
+        self.bg_resizer = None
         try:
-            self.original_bg_image = Image.open("currency.jpg")
+            self.bg_assets = BackgroundAssetCache(BACKGROUND_IMAGE_FILE)
+            self.bg_resizer = BackgroundResizer(master, self.bg_assets, self.set_background_image)
         except FileNotFoundError:
-            print("Error: currency.jpg not found. Please ensure the image file is in the correct directory.")
+            print(f"Error: {BACKGROUND_IMAGE_FILE} not found. Please ensure the image file is in the correct directory.")
+        except OSError as e:
+            print(f"Error: could not load background image: {e}")
 
         self.canvas = tk.Canvas(master, bg="lightgray") # Default canvas background
         self.canvas.pack(fill="both", expand=True)
@@ -86,43 +447,50 @@ class ATMInterface:
 
         self.main_frame = tk.Frame(self.canvas, bg=self.bg_color, highlightbackground="#cfcfcf", highlightthickness=2)
         self.main_window_id = None
+        self.theme.register(self.main_frame, "frame")
+        self.screens = ScreenManager(self.main_frame, on_build=self.theme.register_tree)
+        self.amount_entries = {}
+        self._message_after_id = None
 
         # Create the ToggleSwitch widget as a child of the canvas
         self.dark_mode_toggle_switch = ToggleSwitch(self.canvas, on_toggle_callback=self.toggle_dark_mode,
                                                     initial_state=self.dark_mode,
                                                     bg=self.bg_color) # Pass the initial background color here
+        self.theme.register(self.dark_mode_toggle_switch, "frame")
         # Use create_window to place the toggle switch on the canvas
         self.toggle_switch_window_id = self.canvas.create_window(0, 0, window=self.dark_mode_toggle_switch, anchor="nw") # Initial position, will be updated
 
+        # Shown in the top-left corner while the database is slow or unreachable
+        self.status_banner = tk.Label(self.canvas, font=("Arial", 11), bg="#ffb300", fg="black", padx=8, pady=3)
+        self.status_banner_window_id = self.canvas.create_window(20, 20, window=self.status_banner,
+                                                                 anchor="nw", state="hidden")
+
+        # Database errors escaping any Tk callback switch the kiosk to the offline screen
+        self.master.report_callback_exception = self.on_callback_error
+        self.connection_state = None
+        self._watch_connection()
 
         self.show_welcome()
 
     def toggle_dark_mode(self):
         self.dark_mode = not self.dark_mode
+        if self.dark_mode_toggle_switch.state != self.dark_mode:
+            self.dark_mode_toggle_switch.set_state(self.dark_mode)
         self.set_colors()
-        # Update the ToggleSwitch's internal state so it redraws with the correct colors
-        self.dark_mode_toggle_switch.state = self.dark_mode
-        self.dark_mode_toggle_switch.draw_switch()
-        
-        # Also update the background of the toggle switch canvas itself
-        self.dark_mode_toggle_switch.config(bg=self.bg_color)
+        # One batched recolor of every registered widget; cached screens stay as they are
+        self.theme.apply("dark" if self.dark_mode else "light")
 
-
-        if hasattr(self, '_current_screen_func') and self._current_screen_func:
-            self._current_screen_func()
+    def set_background_image(self, photo):
+        self.bg_photo = photo # Keep a reference so Tk doesn't drop the image
+        if hasattr(self, 'canvas_bg') and self.canvas_bg:
+            self.canvas.itemconfig(self.canvas_bg, image=self.bg_photo)
         else:
-            self.show_welcome()
+            self.canvas_bg = self.canvas.create_image(0, 0, image=self.bg_photo, anchor="nw")
+        self.canvas.tag_lower(self.canvas_bg) # Ensure image is at the bottom
 
     def on_canvas_resize(self, event):
-        if self.original_bg_image:
-            resized_image = self.original_bg_image.resize((event.width, event.height), Image.LANCZOS)
-            self.bg_photo = ImageTk.PhotoImage(resized_image)
-            
-            if hasattr(self, 'canvas_bg') and self.canvas_bg:
-                self.canvas.itemconfig(self.canvas_bg, image=self.bg_photo)
-            else:
-                self.canvas_bg = self.canvas.create_image(0, 0, image=self.bg_photo, anchor="nw")
-            self.canvas.tag_lower(self.canvas_bg) # Ensure image is at the bottom
+        if self.bg_resizer:
+            self.bg_resizer.request(event.width, event.height)
         else:
             self.canvas.config(bg="lightgray")
 
@@ -150,7 +518,6 @@ class ATMInterface:
                                                             anchor="center",
                                                             width=frame_width,
                                                             height=frame_height)
-        self.main_frame.config(bg=self.bg_color)
         
         # Position the toggle switch in the top-right corner of the canvas
         toggle_x = event.width - self.dark_mode_toggle_switch.width - 20 # 20px padding from right
@@ -159,126 +526,125 @@ class ATMInterface:
 
 
     def set_colors(self):
-        if self.dark_mode:
-            self.bg_color = "#2b2b2b"
-            self.fg_color = "white"
-            self.button_bg = "#555555"
-            self.button_fg = "white"
-            self.active_button_bg = "#777777"
-        else:
-            self.bg_color = "#e0e0e0" # Light grey
-            self.fg_color = "#0d47a1"
-            self.button_bg = "#1976d2"
-            self.button_fg = "white"
-            self.active_button_bg = "#1565c0"
-        
-        if hasattr(self, 'main_frame') and self.main_frame:
-            self.main_frame.config(bg=self.bg_color)
-            for widget in self.main_frame.winfo_children():
-                if 'bg' in widget.config():
-                    widget.config(bg=self.bg_color)
-                if 'fg' in widget.config() and not isinstance(widget, tk.Entry):
-                    widget.config(fg=self.fg_color)
-                if isinstance(widget, tk.Button):
-                    widget.config(bg=self.button_bg, fg=self.button_fg, activebackground=self.active_button_bg)
-        
-        # Update the background of the toggle switch canvas directly
-        if hasattr(self, 'dark_mode_toggle_switch') and self.dark_mode_toggle_switch:
-            self.dark_mode_toggle_switch.config(bg=self.bg_color)
-
-
-    def create_button(self, text, command):
-        btn = tk.Button(self.main_frame, text=text, font=("Arial", 14),
+        colors = self.theme.themes["dark" if self.dark_mode else "light"]
+        self.bg_color = colors["bg"]
+        self.fg_color = colors["fg"]
+        self.button_bg = colors["button_bg"]
+        self.button_fg = colors["button_fg"]
+        self.active_button_bg = colors["active_button_bg"]
+
+    def create_button(self, text, command, parent=None):
+        btn = tk.Button(parent or self.main_frame, text=text, font=("Arial", 14),
                          bg=self.button_bg, fg=self.button_fg, relief="flat",
                          padx=10, pady=5,
                          activebackground=self.active_button_bg,
                          activeforeground="white", cursor="hand2",
-                         command=command)
+                         command=lambda: self.run_handler(command))
         btn.bind("<Enter>", lambda e, b=btn: b.config(bg=self.active_button_bg))
         btn.bind("<Leave>", lambda e, b=btn: b.config(bg=self.button_bg))
         return btn
 
+    def run_handler(self, command):
+        # Button handlers query MongoDB on the Tk thread; bound them so a dead server can't hang the window
+        with connection.ui_call():
+            command()
+
+    def show_screen(self, name, build, refresh=None):
+        return self.screens.show(name, build, refresh, bg=self.bg_color)
+
+    def clear_entries(self, *entries):
+        for entry in entries:
+            entry.delete(0, tk.END)
+
     def show_welcome(self):
-        self.clear_frame()
-        self._current_screen_func = self.show_welcome
-        tk.Label(self.main_frame, text="Mongo ATM", font=("Arial", 20),
+        self.show_screen("welcome", self._build_welcome)
+
+    def _build_welcome(self, frame):
+        tk.Label(frame, text="Mongo ATM", font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=30)
 
-        self.create_button("Insert Card", command=self.login_screen).pack(pady=10)
-        self.create_button("Create Account", command=self.create_account_screen).pack(pady=10)
+        self.create_button("Insert Card", command=self.login_screen, parent=frame).pack(pady=10)
+        self.create_button("Create Account", command=self.create_account_screen, parent=frame).pack(pady=10)
 
     def create_account_screen(self):
-        self.clear_frame()
-        self._current_screen_func = self.create_account_screen
-        tk.Label(self.main_frame, text="Create New Account", font=("Arial", 18),
+        self.show_screen("create_account", self._build_create_account,
+                         lambda: self.clear_entries(self.new_card_entry, self.new_account_pin_entry))
+
+    def _build_create_account(self, frame):
+        tk.Label(frame, text="Create New Account", font=("Arial", 18),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
 
-        tk.Label(self.main_frame, text="Card Number:", font=("Arial", 14),
+        tk.Label(frame, text="Card Number:", font=("Arial", 14),
                  bg=self.bg_color, fg=self.fg_color).pack()
-        self.new_card_entry = tk.Entry(self.main_frame, font=("Arial", 14))
+        self.new_card_entry = tk.Entry(frame, font=("Arial", 14))
         self.new_card_entry.pack(pady=5)
 
-        tk.Label(self.main_frame, text="4-digit PIN:", font=("Arial", 14),
+        tk.Label(frame, text="4-digit PIN:", font=("Arial", 14),
                  bg=self.bg_color, fg=self.fg_color).pack()
-        self.new_pin_entry = tk.Entry(self.main_frame, show="*", font=("Arial", 14))
-        self.new_pin_entry.pack(pady=5)
+        self.new_account_pin_entry = tk.Entry(frame, show="*", font=("Arial", 14))
+        self.new_account_pin_entry.pack(pady=5)
 
-        self.create_button("Create", command=self.create_account).pack(pady=10)
-        self.create_button("Back", command=self.show_welcome).pack(pady=10)
+        self.create_button("Create", command=self.create_account, parent=frame).pack(pady=10)
+        self.create_button("Back", command=self.show_welcome, parent=frame).pack(pady=10)
 
     def create_account(self):
-        card = self.new_card_entry.get()
-        pin = self.new_pin_entry.get()
-        if not card:
-            self.show_message("Card number cannot be empty.")
-            return
-        if accounts_collection.find_one({"card": card}):
-            self.show_message("Card number already exists. Please choose another.")
+        if not self.ensure_online():
             return
-        if not pin or len(pin) != 4 or not pin.isdigit():
-            self.show_message("PIN must be 4 digits.")
-            return
-
-        new_account = {"card": card, "pin": pin, "balance": 0.0, "transactions": []}
-        accounts_collection.insert_one(new_account)
-        self.show_message("Account created successfully!", go_back=self.show_welcome)
+        card, pin = self.new_card_entry.get(), self.new_account_pin_entry.get()
+        # Screens are cached, so don't leave credentials sitting in hidden widgets
+        self.clear_entries(self.new_card_entry, self.new_account_pin_entry)
+        result = engine.create_account(card, pin)
+        self.show_message(result.message, go_back=self.show_welcome if result.ok else None)
 
     def login_screen(self):
-        self.clear_frame()
-        self._current_screen_func = self.login_screen
-        tk.Label(self.main_frame, text="Login", font=("Arial", 18),
+        self.show_screen("login", self._build_login,
+                         lambda: self.clear_entries(self.card_entry, self.pin_entry))
+
+    def _build_login(self, frame):
+        tk.Label(frame, text="Login", font=("Arial", 18),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
 
-        tk.Label(self.main_frame, text="Card Number:", font=("Arial", 14),
+        tk.Label(frame, text="Card Number:", font=("Arial", 14),
                  bg=self.bg_color, fg=self.fg_color).pack()
-        self.card_entry = tk.Entry(self.main_frame, font=("Arial", 14))
+        self.card_entry = tk.Entry(frame, font=("Arial", 14))
         self.card_entry.pack(pady=5)
 
-        tk.Label(self.main_frame, text="PIN:", font=("Arial", 14),
+        tk.Label(frame, text="PIN:", font=("Arial", 14),
                  bg=self.bg_color, fg=self.fg_color).pack()
-        self.pin_entry = tk.Entry(self.main_frame, show="*", font=("Arial", 14))
+        self.pin_entry = tk.Entry(frame, show="*", font=("Arial", 14))
         self.pin_entry.pack(pady=5)
 
-        self.create_button("Login", command=self.authenticate).pack(pady=20)
-        self.create_button("Back", command=self.show_welcome).pack(pady=10)
+        self.create_button("Login", command=self.authenticate, parent=frame).pack(pady=20)
+        self.create_button("Back", command=self.show_welcome, parent=frame).pack(pady=10)
 
     def authenticate(self):
-        card = self.card_entry.get()
-        pin = self.pin_entry.get()
-        user = accounts_collection.find_one({"card": card, "pin": pin})
-        if user:
+        card, pin = self.card_entry.get(), self.pin_entry.get()
+        self.clear_entries(self.card_entry, self.pin_entry)
+        try:
+            if connection.available:
+                ok = engine.authenticate(card, pin).ok
+                if ok:
+                    # Remember credentials and balance so this card can still be served offline
+                    syncer.refresh_account(card, pin)
+            else:
+                ok = outbox.authenticate(card, pin)
+        except pymongo.errors.PyMongoError as e:
+            connection.mark_offline(e)
+            ok = outbox.authenticate(card, pin)
+        if ok:
             self.current_user = card
             self.main_menu()
         else:
             self.show_message("Invalid Card Number or PIN")
 
     def main_menu(self):
-        self.clear_frame()
-        self._current_screen_func = self.main_menu
-        tk.Label(self.main_frame, text="Main Menu", font=("Arial", 20),
+        self.show_screen("main_menu", self._build_main_menu)
+
+    def _build_main_menu(self, frame):
+        tk.Label(frame, text="Main Menu", font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=10)
 
-        menu_buttons_frame = tk.Frame(self.main_frame, bg=self.bg_color)
+        menu_buttons_frame = tk.Frame(frame, bg=self.bg_color)
         menu_buttons_frame.pack(pady=20, fill="both", expand=True)
 
         options = [
@@ -286,20 +652,14 @@ class ATMInterface:
             ("Deposit Cash", self.deposit_screen),
             ("Balance Inquiry", self.show_balance_screen),
             ("Mini Statement", self.show_mini_statement_screen),
+            ("Full Statement", self.statement_screen),
             ("Change PIN", self.change_pin_screen),
             ("Money Transfer", self.transfer_money_screen),
             ("Logout", self.logout)
         ]
 
         for i, (text, func) in enumerate(options):
-            btn = tk.Button(menu_buttons_frame, text=text, font=("Arial", 14),
-                             bg=self.button_bg, fg=self.button_fg, relief="flat",
-                             padx=10, pady=5,
-                             activebackground=self.active_button_bg,
-                             activeforeground="white", cursor="hand2",
-                             command=func)
-            btn.bind("<Enter>", lambda e, b=btn: b.config(bg=self.active_button_bg))
-            btn.bind("<Leave>", lambda e, b=btn: b.config(bg=self.button_bg))
+            btn = self.create_button(text, command=func, parent=menu_buttons_frame)
             btn.grid(row=i, column=0, padx=10, pady=5, sticky="ew")
 
         menu_buttons_frame.grid_columnconfigure(0, weight=1)
@@ -307,39 +667,29 @@ class ATMInterface:
             menu_buttons_frame.grid_rowconfigure(i, weight=1)
 
     def transaction_screen(self, title, action_func):
-        self.clear_frame()
-        self._current_screen_func = lambda: self.transaction_screen(title, action_func)
-        
-        tk.Label(self.main_frame, text=title, font=("Arial", 20),
+        self.show_screen(title, lambda frame: self._build_transaction(frame, title, action_func),
+                         lambda: self._refresh_transaction(title))
+
+    def _build_transaction(self, frame, title, action_func):
+        tk.Label(frame, text=title, font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
 
-        tk.Label(self.main_frame, text="Enter amount:", font=("Arial", 14),
+        tk.Label(frame, text="Enter amount:", font=("Arial", 14),
                  bg=self.bg_color, fg=self.fg_color).pack()
-        self.amount_entry = tk.Entry(self.main_frame, font=("Arial", 14))
-        self.amount_entry.pack(pady=10)
+        amount_entry = tk.Entry(frame, font=("Arial", 14))
+        amount_entry.pack(pady=10)
+        self.amount_entries[title] = amount_entry
 
-        self.create_button(title, action_func).pack(pady=5)
-        self.create_button("Back", command=self.main_menu).pack(pady=5)
+        self.create_button(title, action_func, parent=frame).pack(pady=5)
+        self.create_button("Back", command=self.main_menu, parent=frame).pack(pady=5)
 
-    def withdraw(self):
-        try:
-            amount = float(self.amount_entry.get())
-            if amount <= 0:
-                self.show_message("Amount must be positive.")
-                return
+    def _refresh_transaction(self, title):
+        # Withdraw and Deposit are separate cached screens; point amount_entry at the visible one
+        self.amount_entry = self.amount_entries[title]
+        self.clear_entries(self.amount_entry)
 
-            user = accounts_collection.find_one({"card": self.current_user})
-            if user['balance'] >= amount:
-                accounts_collection.update_one(
-                    {"card": self.current_user},
-                    {"$inc": {"balance": -amount},
-                     "$push": {"transactions": self.get_transaction(f"Withdrawn: ${amount:.2f}")}}
-                )
-                self.show_message(f"Withdrawn ${amount:.2f}", go_back=self.main_menu)
-            else:
-                self.show_message("Not enough balance")
-        except ValueError:
-            self.show_message("Invalid amount")
+    def withdraw(self):
+        self.cash_operation("withdraw")
 
     def deposit_screen(self):
         self.transaction_screen("Deposit Cash", self.deposit)
@@ -348,168 +698,340 @@ class ATMInterface:
         self.transaction_screen("Withdraw Cash", self.withdraw)
 
     def deposit(self):
-        try:
-            amount = float(self.amount_entry.get())
-            if amount <= 0:
-                self.show_message("Amount must be positive.")
+        self.cash_operation("deposit")
+
+    def cash_operation(self, op):
+        # Online first. If the bank is unreachable, or drops mid-call, the operation is journaled
+        # locally under the same idempotency key, so the syncer can never apply it twice.
+        amount = self.amount_entry.get()
+        key = outbox.new_key()
+        if connection.available:
+            try:
+                result = getattr(engine, op)(self.current_user, amount, idempotency_key=key)
+                if result.ok:
+                    cents = to_cents(amount)
+                    outbox.adjust_cached_balance(self.current_user, cents if op == "deposit" else -cents)
+                self.show_message(result.message, go_back=self.main_menu if result.ok else None)
                 return
+            except pymongo.errors.PyMongoError as e:
+                connection.mark_offline(e)
 
-            accounts_collection.update_one(
-                {"card": self.current_user},
-                {"$inc": {"balance": amount},
-                 "$push": {"transactions": self.get_transaction(f"Deposited: ${amount:.2f}")}}
-            )
-            self.show_message(f"Deposited ${amount:.2f}", go_back=self.main_menu)
+        try:
+            cents = to_cents(amount)
         except ValueError:
             self.show_message("Invalid amount")
+            return
+        if cents <= 0:
+            self.show_message("Amount must be positive.")
+            return
+        if op == "deposit":
+            message = outbox.deposit(self.current_user, cents, key)
+        else:
+            message = outbox.withdraw(self.current_user, cents, key)
+        if message:
+            self.show_message(message, go_back=self.main_menu)
+        else:
+            self.show_message("Not enough balance available offline")
 
     def show_balance_screen(self):
-        self.clear_frame()
-        self._current_screen_func = self.show_balance_screen
-        user = accounts_collection.find_one({"card": self.current_user})
-        tk.Label(self.main_frame, text="Balance Inquiry", font=("Arial", 20),
+        self.show_screen("balance", self._build_balance, self._refresh_balance)
+
+    def _build_balance(self, frame):
+        tk.Label(frame, text="Balance Inquiry", font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
-        tk.Label(self.main_frame, text=f"Current Balance: ${user['balance']:.2f}", font=("Arial", 16),
-                 bg=self.bg_color, fg=self.fg_color).pack(pady=10)
-        self.create_button("Back", command=self.main_menu).pack(pady=10)
+        self.balance_label = tk.Label(frame, font=("Arial", 16),
+                                      bg=self.bg_color, fg=self.fg_color)
+        self.balance_label.pack(pady=10)
+        self.create_button("Back", command=self.main_menu, parent=frame).pack(pady=10)
+
+    def _refresh_balance(self):
+        if connection.available:
+            self.balance_label.config(text=engine.balance(self.current_user).message)
+            return
+        cents, as_of = outbox.cached_balance(self.current_user)
+        if cents is None:
+            self.balance_label.config(text="Balance unavailable offline")
+        else:
+            self.balance_label.config(text=f"Current Balance: ${format_cents(cents)}\n(offline, last synced {as_of})")
 
     def show_mini_statement_screen(self):
-        self.clear_frame()
-        self._current_screen_func = self.show_mini_statement_screen
-        user = accounts_collection.find_one({"card": self.current_user})
-        transactions = user.get('transactions', [])[-5:]
-        tk.Label(self.main_frame, text="Mini Statement", font=("Arial", 20),
+        if not self.ensure_online():
+            return
+        self.show_screen("mini_statement", self._build_mini_statement, self._refresh_mini_statement)
+
+    def _build_mini_statement(self, frame):
+        tk.Label(frame, text="Mini Statement", font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
+        self.mini_statement_label = tk.Label(frame, bg=self.bg_color, fg=self.fg_color)
+        self.mini_statement_label.pack()
+        self.create_button("Back", command=self.main_menu, parent=frame).pack(pady=10)
+
+    def _refresh_mini_statement(self):
+        transactions = engine.mini_statement(self.current_user).data or []
         if not transactions:
-            tk.Label(self.main_frame, text="No recent transactions", font=("Arial", 14),
-                     bg=self.bg_color, fg=self.fg_color).pack()
+            self.mini_statement_label.config(text="No recent transactions", font=("Arial", 14))
         else:
-            for txn in transactions:
-                tk.Label(self.main_frame, text=txn, font=("Arial", 12),
-                         bg=self.bg_color, fg=self.fg_color).pack()
-        self.create_button("Back", command=self.main_menu).pack(pady=10)
+            self.mini_statement_label.config(text="\n".join(transactions), font=("Arial", 12))
+
+    def statement_screen(self):
+        if not self.ensure_online():
+            return
+        self.show_screen("statement", self._build_statement, self._refresh_statement)
+
+    def _build_statement(self, frame):
+        tk.Label(frame, text="Account Statement", font=("Arial", 20),
+                 bg=self.bg_color, fg=self.fg_color).pack(pady=10)
+
+        range_frame = tk.Frame(frame, bg=self.bg_color)
+        range_frame.pack(pady=5)
+        tk.Label(range_frame, text="From:", font=("Arial", 12), bg=self.bg_color, fg=self.fg_color).grid(row=0, column=0)
+        self.statement_from_entry = tk.Entry(range_frame, font=("Arial", 12), width=11)
+        self.statement_from_entry.grid(row=0, column=1, padx=5)
+        tk.Label(range_frame, text="To:", font=("Arial", 12), bg=self.bg_color, fg=self.fg_color).grid(row=0, column=2)
+        self.statement_to_entry = tk.Entry(range_frame, font=("Arial", 12), width=11)
+        self.statement_to_entry.grid(row=0, column=3, padx=5)
+        tk.Label(frame, text="Dates as YYYY-MM-DD; leave empty for all", font=("Arial", 10),
+                 bg=self.bg_color, fg=self.fg_color).pack()
+
+        list_frame = tk.Frame(frame, bg=self.bg_color)
+        list_frame.pack(pady=5, padx=10, fill="both", expand=True)
+        scrollbar = tk.Scrollbar(list_frame, orient="vertical")
+        self.statement_list = tk.Listbox(list_frame, font=("Courier", 10), height=8, bd=0,
+                                         yscrollcommand=scrollbar.set)
+        scrollbar.config(command=self.statement_list.yview)
+        scrollbar.pack(side="right", fill="y")
+        self.statement_list.pack(side="left", fill="both", expand=True)
+
+        nav_frame = tk.Frame(frame, bg=self.bg_color)
+        nav_frame.pack(pady=5)
+        self.create_button("Show", self._load_statement_range, parent=nav_frame).grid(row=0, column=0, padx=3)
+        self.statement_prev_button = self.create_button("Prev", self._statement_prev_page, parent=nav_frame)
+        self.statement_prev_button.grid(row=0, column=1, padx=3)
+        self.statement_next_button = self.create_button("Next", self._statement_next_page, parent=nav_frame)
+        self.statement_next_button.grid(row=0, column=2, padx=3)
+        self.create_button("Export", self.export_statement, parent=nav_frame).grid(row=0, column=3, padx=3)
+
+        self.statement_status_label = tk.Label(frame, font=("Arial", 10), bg=self.bg_color, fg=self.fg_color)
+        self.statement_status_label.pack()
+        self.create_button("Back", command=self.main_menu, parent=frame).pack(pady=5)
+
+    def _refresh_statement(self):
+        self.clear_entries(self.statement_from_entry, self.statement_to_entry)
+        self._load_statement_range()
+
+    def _load_statement_range(self):
+        try:
+            self.statement_range = parse_date_range(self.statement_from_entry.get(), self.statement_to_entry.get())
+        except ValueError:
+            self.statement_status_label.config(text="Invalid date range")
+            return
+        # Keyset pagination: remember the (ts, _id) key each visited page started after
+        self.statement_page_keys = [None]
+        self._show_statement_page()
+
+    def _show_statement_page(self):
+        start, end = self.statement_range
+        page = engine.statement_page(self.current_user, start, end, after=self.statement_page_keys[-1]).data
+        self.statement_next_key = page["next"]
+        self.statement_list.delete(0, tk.END)
+        self.statement_list.insert(tk.END, *(page["lines"] or ["No transactions in this period"]))
+        self.statement_prev_button.config(state="normal" if len(self.statement_page_keys) > 1 else "disabled")
+        self.statement_next_button.config(state="normal" if page["next"] else "disabled")
+        self.statement_status_label.config(text=f"Page {len(self.statement_page_keys)}")
+
+    def _statement_next_page(self):
+        if self.statement_next_key:
+            self.statement_page_keys.append(self.statement_next_key)
+            self._show_statement_page()
+
+    def _statement_prev_page(self):
+        if len(self.statement_page_keys) > 1:
+            self.statement_page_keys.pop()
+            self._show_statement_page()
+
+    def export_statement(self):
+        # Export what the date entries say now, even if they were edited since the last "Show"
+        try:
+            start, end = parse_date_range(self.statement_from_entry.get(), self.statement_to_entry.get())
+        except ValueError:
+            self.statement_status_label.config(text="Invalid date range")
+            return
+        path = filedialog.asksaveasfilename(parent=self.master, title="Export Statement",
+                                            defaultextension=".txt", filetypes=[("Text files", "*.txt")],
+                                            initialfile=f"statement_{self.current_user}.txt")
+        if not path:
+            return
+        card = self.current_user
+        self.statement_status_label.config(text="Exporting...")
+        results = queue.Queue()
+
+        def run_export():
+            try:
+                with open(path, 'w') as out:
+                    results.put(engine.export_statement(card, out, start, end).message)
+            except Exception as e:
+                results.put(f"Export failed: {e}")
+
+        # Large statements stream on a worker thread so the kiosk stays responsive
+        threading.Thread(target=run_export, daemon=True).start()
+        self._poll_export(results)
+
+    def _poll_export(self, results):
+        try:
+            self.statement_status_label.config(text=results.get_nowait())
+        except queue.Empty:
+            self.master.after(100, self._poll_export, results)
 
     def change_pin_screen(self):
-        self.clear_frame()
-        self._current_screen_func = self.change_pin_screen
-        tk.Label(self.main_frame, text="Change PIN", font=("Arial", 20),
+        self.show_screen("change_pin", self._build_change_pin,
+                         lambda: self.clear_entries(self.old_pin_entry, self.new_pin_entry, self.confirm_pin_entry))
+
+    def _build_change_pin(self, frame):
+        tk.Label(frame, text="Change PIN", font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
 
-        tk.Label(self.main_frame, text="Old PIN:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
-        self.old_pin_entry = tk.Entry(self.main_frame, show='*', font=("Arial", 14))
+        tk.Label(frame, text="Old PIN:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
+        self.old_pin_entry = tk.Entry(frame, show='*', font=("Arial", 14))
         self.old_pin_entry.pack(pady=5)
 
-        tk.Label(self.main_frame, text="New PIN (4 digits):", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
-        self.new_pin_entry = tk.Entry(self.main_frame, show='*', font=("Arial", 14))
+        tk.Label(frame, text="New PIN (4 digits):", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
+        self.new_pin_entry = tk.Entry(frame, show='*', font=("Arial", 14))
         self.new_pin_entry.pack(pady=5)
 
-        tk.Label(self.main_frame, text="Confirm New PIN:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
-        self.confirm_pin_entry = tk.Entry(self.main_frame, show='*', font=("Arial", 14))
+        tk.Label(frame, text="Confirm New PIN:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
+        self.confirm_pin_entry = tk.Entry(frame, show='*', font=("Arial", 14))
         self.confirm_pin_entry.pack(pady=5)
 
-        self.create_button("Change", command=self.change_pin).pack(pady=10)
-        self.create_button("Back", command=self.main_menu).pack(pady=5)
+        self.create_button("Change", command=self.change_pin, parent=frame).pack(pady=10)
+        self.create_button("Back", command=self.main_menu, parent=frame).pack(pady=5)
 
     def change_pin(self):
-        user = accounts_collection.find_one({"card": self.current_user})
-        old_pin = self.old_pin_entry.get()
-        new_pin = self.new_pin_entry.get()
-        confirm_pin = self.confirm_pin_entry.get()
-
-        if old_pin != user['pin']:
-            self.show_message("Incorrect old PIN")
+        if not self.ensure_online():
             return
-
-        if not new_pin or len(new_pin) != 4 or not new_pin.isdigit():
-            self.show_message("New PIN must be 4 digits.")
-            return
-
-        if new_pin != confirm_pin:
-            self.show_message("New PINs do not match")
-            return
-
-        accounts_collection.update_one({"card": self.current_user}, {"$set": {"pin": new_pin}})
-        self.show_message("PIN changed successfully", go_back=self.main_menu)
+        old_pin, new_pin, confirm_pin = (self.old_pin_entry.get(), self.new_pin_entry.get(),
+                                         self.confirm_pin_entry.get())
+        self.clear_entries(self.old_pin_entry, self.new_pin_entry, self.confirm_pin_entry)
+        result = engine.change_pin(self.current_user, old_pin, new_pin, confirm_pin)
+        if result.ok:
+            outbox.update_cached_pin(self.current_user, new_pin)
+        self.show_message(result.message, go_back=self.main_menu if result.ok else None)
 
     def transfer_money_screen(self):
-        self.clear_frame()
-        self._current_screen_func = self.transfer_money_screen
-        tk.Label(self.main_frame, text="Transfer Money", font=("Arial", 20),
+        self.show_screen("transfer", self._build_transfer,
+                         lambda: self.clear_entries(self.receiver_entry, self.transfer_amount_entry))
+
+    def _build_transfer(self, frame):
+        tk.Label(frame, text="Transfer Money", font=("Arial", 20),
                  bg=self.bg_color, fg=self.fg_color).pack(pady=20)
 
-        tk.Label(self.main_frame, text="Receiver Card Number:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
-        self.receiver_entry = tk.Entry(self.main_frame, font=("Arial", 14))
+        tk.Label(frame, text="Receiver Card Number:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
+        self.receiver_entry = tk.Entry(frame, font=("Arial", 14))
         self.receiver_entry.pack(pady=5)
 
-        tk.Label(self.main_frame, text="Amount:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
-        self.transfer_amount_entry = tk.Entry(self.main_frame, font=("Arial", 14))
+        tk.Label(frame, text="Amount:", font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack()
+        self.transfer_amount_entry = tk.Entry(frame, font=("Arial", 14))
         self.transfer_amount_entry.pack(pady=5)
 
-        self.create_button("Transfer", command=self.transfer_money).pack(pady=10)
-        self.create_button("Back", command=self.main_menu).pack(pady=5)
+        self.create_button("Transfer", command=self.transfer_money, parent=frame).pack(pady=10)
+        self.create_button("Back", command=self.main_menu, parent=frame).pack(pady=5)
 
     def transfer_money(self):
-        receiver = self.receiver_entry.get()
+        # New transfers need the bank (the receiver can't be checked offline). One that loses the
+        # connection mid-call is journaled under its key, so the syncer completes or reverses it.
+        if not self.ensure_online():
+            return
+        receiver, amount = self.receiver_entry.get(), self.transfer_amount_entry.get()
+        key = outbox.new_key()
         try:
-            amount = float(self.transfer_amount_entry.get())
-            if amount <= 0:
-                self.show_message("Transfer amount must be positive.")
-                return
-
-            sender_data = accounts_collection.find_one({"card": self.current_user})
-            receiver_data = accounts_collection.find_one({"card": receiver})
-
-            if receiver == self.current_user:
-                self.show_message("Cannot transfer to the same account.")
-                return
-
-            if not receiver_data:
-                self.show_message("Receiver card number does not exist.")
-                return
-
-            if sender_data['balance'] < amount:
-                self.show_message("Insufficient funds for transfer.")
-                return
-
-            accounts_collection.update_one(
-                {"card": self.current_user},
-                {"$inc": {"balance": -amount},
-                 "$push": {"transactions": self.get_transaction(f"Transferred ${amount:.2f} to {receiver}")}}
-            )
-            accounts_collection.update_one(
-                {"card": receiver},
-                {"$inc": {"balance": amount},
-                 "$push": {"transactions": self.get_transaction(f"Received ${amount:.2f} from {self.current_user}")}}
-            )
-            self.show_message(f"Transferred ${amount:.2f} to {receiver}", go_back=self.main_menu)
-
-        except ValueError:
-            self.show_message("Invalid amount. Please enter a number.")
+            result = engine.transfer(self.current_user, receiver, amount, idempotency_key=key)
+        except pymongo.errors.PyMongoError as e:
+            connection.mark_offline(e)
+            self.show_message(outbox.transfer(self.current_user, receiver, to_cents(amount), key), go_back=self.main_menu)
+            return
         except Exception as e:
             self.show_message(f"An error occurred: {e}")
+            return
+        if result.ok:
+            cents = to_cents(amount)
+            outbox.adjust_cached_balance(self.current_user, -cents)
+            outbox.adjust_cached_balance(receiver, cents)
+        self.show_message(result.message, go_back=self.main_menu if result.ok else None)
 
     def logout(self):
         self.current_user = None
         self.show_message("Logged out successfully", go_back=self.show_welcome)
 
     def show_message(self, text, go_back=None):
-        self.clear_frame()
         message_color = "green" if "success" in text.lower() or "withdrawn" in text.lower() or "deposited" in text.lower() or "transferred" in text.lower() else "red"
-        tk.Label(self.main_frame, text=text, font=("Arial", 16), bg=self.bg_color, fg=message_color).pack(pady=30)
+        self.show_screen("message", self._build_message)
+        self.message_label.config(text=text, fg=message_color)
+        if self._message_after_id:
+            self.master.after_cancel(self._message_after_id)
+            self._message_after_id = None
         if go_back:
-            self.master.after(2000, go_back)
+            self._message_after_id = self.master.after(2000, go_back)
+
+    def _build_message(self, frame):
+        self.message_label = self.theme.register(tk.Label(frame, font=("Arial", 16)), "message")
+        self.message_label.pack(pady=30)
 
-    def get_transaction(self, description):
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        return f"{timestamp} - {description}"
+    def ensure_online(self):
+        if connection.available:
+            return True
+        self.show_offline()
+        return False
 
-    def clear_frame(self):
-        for widget in self.main_frame.winfo_children():
-            widget.destroy()
-        self.main_frame.config(bg=self.bg_color)
+    def show_offline(self):
+        self.show_screen("offline", self._build_offline)
+
+    def _build_offline(self, frame):
+        tk.Label(frame, text="Out of Service", font=("Arial", 20),
+                 bg=self.bg_color, fg=self.fg_color).pack(pady=30)
+        tk.Label(frame, text="This service needs a connection to the bank.\n"
+                             "Deposits and withdrawals remain available.\nReconnecting automatically...",
+                 font=("Arial", 14), bg=self.bg_color, fg=self.fg_color).pack(pady=10)
+        self.create_button("Back", command=self._leave_offline, parent=frame).pack(pady=10)
+
+    def _leave_offline(self):
+        if self.current_user:
+            self.main_menu()
+        else:
+            self.show_welcome()
+
+    def _watch_connection(self):
+        # The probe runs on its own thread; Tk widgets are only touched here, on the Tk thread
+        state = connection.state
+        if state != self.connection_state:
+            previous, self.connection_state = self.connection_state, state
+            if state in STATUS_BANNER_TEXT:
+                self.status_banner.config(text=STATUS_BANNER_TEXT[state])
+                self.canvas.itemconfig(self.status_banner_window_id, state="normal")
+            else:
+                self.canvas.itemconfig(self.status_banner_window_id, state="hidden")
+            if previous in UNAVAILABLE and state not in UNAVAILABLE:
+                syncer.wake() # Replay the offline journal right away
+                if self.screens.current == "offline":
+                    self._leave_offline()
+        self.master.after(CONNECTION_POLL_MS, self._watch_connection)
+
+    def on_callback_error(self, exc, val, tb):
+        if isinstance(val, pymongo.errors.PyMongoError):
+            connection.mark_offline(val)
+            self.show_offline()
+            return
+        traceback.print_exception(exc, val, tb)
 
 
 if __name__ == '__main__':
+    # Warm-up (indexes, ledger migration) runs on the probe thread once the server answers,
+    # so the window comes up immediately even when MongoDB is down
+    outbox = OfflineOutbox(OUTBOX_FILE)
+    syncer = OutboxSyncer(outbox, engine, connection)
+    connection.start(on_connect=engine.prepare)
+    syncer.start()
     root = tk.Tk()
     atm = ATMInterface(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    syncer.stop()
+    outbox.close()
+    connection.close()
\ No newline at end of file
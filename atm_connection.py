@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+import traceback
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+ONLINE = "online"
+DEGRADED = "degraded" # Reachable, but pings are slower than degraded_latency_ms
+OFFLINE = "offline"
+STARTING = "starting" # Reachable, but the warm-up hook (indexes, ledger migration) hasn't finished
+UNAVAILABLE = (STARTING, OFFLINE) # States in which DB-backed handlers must not run
+
+
+# --- MongoDB Connection Manager ---
+class MongoConnectionManager:
+    # Owns the one MongoClient for the kiosk. The client is built lazily with explicit pool and
+    # timeout settings; start() warms it up and keeps probing health on a daemon thread, so the
+    # UI can read `state` instead of discovering an outage inside a button handler.
+    # socket_timeout_ms bounds background work (warm-up, syncer, exports); handlers on the Tk
+    # thread run under the much shorter ui_timeout_ms deadline instead (see ui_call).
+    def __init__(self, uri="mongodb://localhost:27017/", db_name="atm_system",
+                 max_pool_size=20, min_pool_size=2, server_selection_timeout_ms=2000,
+                 connect_timeout_ms=2000, socket_timeout_ms=10000, ui_timeout_ms=2000,
+                 health_interval=5.0, offline_retry_interval=1.0, degraded_latency_ms=500):
+        self.uri = uri
+        self.db_name = db_name
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.server_selection_timeout_ms = server_selection_timeout_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.socket_timeout_ms = socket_timeout_ms
+        self.ui_timeout_ms = ui_timeout_ms
+        self.health_interval = health_interval
+        self.offline_retry_interval = offline_retry_interval
+        self.degraded_latency_ms = degraded_latency_ms
+
+        self.state = None # Unknown until the first probe completes
+        self.warmed_up = True # Cleared by start() while an on_connect hook is pending
+        self.last_latency_ms = None
+        self.last_error = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._probe_thread = None
+
+    @classmethod
+    def from_env(cls, environ=None):
+        # ATM_MONGO_* environment variables override the defaults above
+        environ = os.environ if environ is None else environ
+        options = {}
+        for name, key, cast in (
+            ("uri", "ATM_MONGO_URI", str),
+            ("db_name", "ATM_MONGO_DB", str),
+            ("max_pool_size", "ATM_MONGO_MAX_POOL_SIZE", int),
+            ("min_pool_size", "ATM_MONGO_MIN_POOL_SIZE", int),
+            ("server_selection_timeout_ms", "ATM_MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+            ("connect_timeout_ms", "ATM_MONGO_CONNECT_TIMEOUT_MS", int),
+            ("socket_timeout_ms", "ATM_MONGO_SOCKET_TIMEOUT_MS", int),
+            ("ui_timeout_ms", "ATM_MONGO_UI_TIMEOUT_MS", int),
+            ("health_interval", "ATM_MONGO_HEALTH_INTERVAL", float),
+            ("offline_retry_interval", "ATM_MONGO_OFFLINE_RETRY_INTERVAL", float),
+            ("degraded_latency_ms", "ATM_MONGO_DEGRADED_LATENCY_MS", float),
+        ):
+            if environ.get(key):
+                options[name] = cast(environ[key])
+        return cls(**options)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                # connect=False: no network I/O until the first operation or probe
+                self._client = pymongo.MongoClient(
+                    self.uri,
+                    maxPoolSize=self.max_pool_size,
+                    minPoolSize=self.min_pool_size,
+                    serverSelectionTimeoutMS=self.server_selection_timeout_ms,
+                    connectTimeoutMS=self.connect_timeout_ms,
+                    socketTimeoutMS=self.socket_timeout_ms,
+                    connect=False,
+                )
+            return self._client
+
+    def database(self):
+        return self.client[self.db_name]
+
+    def ui_call(self):
+        # Context manager giving everything a Tk handler does one shared deadline, server selection
+        # included, so an unresponsive server freezes the window for at most ui_timeout_ms.
+        # It is per-thread: worker threads started inside the handler aren't bound by it.
+        return pymongo.timeout(self.ui_timeout_ms / 1000.0)
+
+    def ping(self):
+        start = time.perf_counter()
+        try:
+            self.client.admin.command("ping")
+        except PyMongoError as e:
+            self.last_error = e
+            self.state = OFFLINE
+            return False
+        self.last_latency_ms = (time.perf_counter() - start) * 1000
+        if not self.warmed_up:
+            self.state = STARTING
+        else:
+            self.state = DEGRADED if self.last_latency_ms > self.degraded_latency_ms else ONLINE
+        return True
+
+    def mark_offline(self, error=None):
+        # Called when a real operation fails, so the UI reacts before the next probe
+        self.last_error = error
+        self.state = OFFLINE
+
+    @property
+    def available(self):
+        return self.state not in UNAVAILABLE
+
+    def start(self, on_connect=None):
+        # on_connect runs once, on the probe thread, after the first successful ping (warm-up hook).
+        # Until it succeeds the state stays STARTING, so handlers can't race the ledger migration.
+        if self._probe_thread:
+            return
+        if on_connect:
+            self.warmed_up = False
+            self.state = STARTING
+        self._stop.clear()
+        self._probe_thread = threading.Thread(target=self._probe_loop, args=(on_connect,), daemon=True)
+        self._probe_thread.start()
+
+    def _probe_loop(self, on_connect):
+        pending_warm_up = on_connect
+        while not self._stop.is_set():
+            if self.ping() and pending_warm_up:
+                try:
+                    pending_warm_up()
+                except PyMongoError as e:
+                    self.mark_offline(e)
+                except Exception as e:
+                    # Anything else (bad legacy data, a bug) is logged and retried; it must not end the probe thread
+                    self.last_error = e
+                    traceback.print_exc()
+                else:
+                    pending_warm_up = None
+                    self.warmed_up = True
+                    self.ping() # Publish ONLINE/DEGRADED now rather than after the next interval
+            # Retry quickly while unavailable so the kiosk comes back as soon as the server does
+            self._stop.wait(self.offline_retry_interval if self.state in UNAVAILABLE else self.health_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._probe_thread:
+            self._probe_thread.join(timeout=self.server_selection_timeout_ms / 1000.0 + 1)
+            self._probe_thread = None
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
@@ -0,0 +1,578 @@
+import argparse
+import hashlib
+import json
+import sys
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+
+import pymongo
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from atm_ledger import (Ledger, CASH_ACCOUNT, SNAPSHOT_EVERY, INTENT_PENDING, to_cents, format_cents,
+                        is_system_account, format_entry_line, format_statement_line)
+
+# Every engine call returns a Result; message is the text the GUI shows to the user
+Result = namedtuple("Result", ["ok", "message", "data"], defaults=[None])
+
+DEFAULT_MONGO_URI = "mongodb://localhost:27017/"
+DEFAULT_BATCH_SIZE = 5000
+BATCH_CONFLICT_RETRIES = 3 # Fresh prefetches tried when another writer changes a batch's accounts
+STATEMENT_PAGE_SIZE = 20
+LEGACY_PAGE_KEY = "legacy" # Page keys into pre-ledger history are (LEGACY_PAGE_KEY, index in "transactions")
+
+
+def valid_pin(pin):
+    return bool(pin) and len(pin) == 4 and pin.isdigit()
+
+
+def parse_date_range(start_text, end_text):
+    # "YYYY-MM-DD" strings, both inclusive and optional; returns datetimes for [start, end)
+    start = datetime.strptime(start_text.strip(), "%Y-%m-%d") if start_text and start_text.strip() else None
+    end = datetime.strptime(end_text.strip(), "%Y-%m-%d") + timedelta(days=1) if end_text and end_text.strip() else None
+    if start and end and start >= end:
+        raise ValueError("start date is after end date")
+    return start, end
+
+
+def format_legacy_line(ts, line):
+    # Pre-ledger history lines are free text, "YYYY-MM-DD HH:MM:SS - memo", with no signed amount
+    if ts is None:
+        return f"{'':19}  {'(legacy)':>12}  {line}"
+    return f"{ts:%Y-%m-%d %H:%M:%S}  {'(legacy)':>12}  {line[19:].lstrip(' -')}"
+
+
+def describe_period(start, end):
+    last_day = f"{end - timedelta(days=1):%Y-%m-%d}" if end else None
+    if start and end:
+        return f"{start:%Y-%m-%d} to {last_day}"
+    if start:
+        return f"from {start:%Y-%m-%d}"
+    return f"until {last_day}" if end else "all dates"
+
+
+# --- Headless ATM Engine ---
+class ATMEngine:
+    # All ATM business rules, driven by explicit arguments instead of Tk entries.
+    # The GUI, the batch runner and scripts all go through this class.
+    def __init__(self, db):
+        self.db = db
+        self.accounts = db["accounts"]
+        self.ledger = Ledger(db)
+
+    def prepare(self):
+        self.ledger.ensure_indexes()
+        self.ledger.repair_incomplete()
+        return self.ledger.migrate_legacy_accounts()
+
+    def create_account(self, card, pin):
+        if not card:
+            return Result(False, "Card number cannot be empty.")
+        # "@" names belong to the ledger's system accounts, which have no funds check
+        if is_system_account(card) or self.accounts.find_one({"card": card}, {"_id": 1}):
+            return Result(False, "Card number already exists. Please choose another.")
+        if not valid_pin(pin):
+            return Result(False, "PIN must be 4 digits.")
+
+        try:
+            self.accounts.insert_one(self.new_account(card, pin))
+        except DuplicateKeyError: # Created at another kiosk since the check above
+            return Result(False, "Card number already exists. Please choose another.")
+        return Result(True, "Account created successfully!")
+
+    @staticmethod
+    def new_account(card, pin):
+        return {"card": card, "pin": pin, "balance_cents": 0, "ledger_seq": 0}
+
+    def find_account(self, card, projection=None):
+        # Customer accounts only: "@" names are ledger system accounts, never cards
+        if not isinstance(card, str) or is_system_account(card):
+            return None
+        return self.accounts.find_one({"card": card}, projection)
+
+    def authenticate(self, card, pin):
+        if not is_system_account(card) and self.accounts.find_one({"card": card, "pin": pin}, {"_id": 1}):
+            return Result(True, "Login successful")
+        return Result(False, "Invalid Card Number or PIN")
+
+    def balance(self, card):
+        if not self.find_account(card, {"_id": 1}):
+            return Result(False, "Account not found")
+        cents = self.ledger.balance(card)
+        return Result(True, f"Current Balance: ${format_cents(cents)}", cents)
+
+    def mini_statement(self, card, count=5):
+        user = self.find_account(card, {"transactions": {"$slice": -count}})
+        if not user:
+            return Result(False, "Account not found")
+        lines = []
+        recent = self.ledger.journal.find({"legs.account": card, "state": {"$ne": INTENT_PENDING}})
+        for entry in recent.sort([("ts", -1), ("_id", -1)]).limit(count):
+            lines.extend(format_entry_line(entry, leg) for leg in entry["legs"] if leg["account"] == card)
+        lines.reverse()
+        # Accounts migrated from before the ledger keep their old free-text history
+        legacy = user.get('transactions', [])
+        lines = legacy[max(0, len(legacy) - (count - len(lines))):] + lines if len(lines) < count else lines
+        return Result(True, "Mini Statement", lines)
+
+    def legacy_history(self, card, start=None, end=None):
+        # Yields (index, ts, line) from the free-text history of accounts migrated from before the
+        # ledger. Lines whose timestamp can't be read are only included when no range is given.
+        user = self.find_account(card, {"transactions": 1})
+        for index, line in enumerate(user.get("transactions", []) if user else []):
+            try:
+                ts = datetime.strptime(line[:19], "%Y-%m-%d %H:%M:%S")
+            except (TypeError, ValueError):
+                ts = None
+            if (start or end) and (ts is None or (start and ts < start) or (end and ts >= end)):
+                continue
+            yield index, ts, line
+
+    def _statement_lines(self, card, start, end, after, batch_size):
+        # (page key, line) in statement order: pre-ledger history first, then the ledger's legs
+        if after is None or after[0] == LEGACY_PAGE_KEY:
+            for index, ts, line in self.legacy_history(card, start, end):
+                if after is None or index > after[1]:
+                    yield (LEGACY_PAGE_KEY, index), format_legacy_line(ts, line)
+            after = None
+        for entry, leg in self.ledger.statement(card, start, end, after, batch_size=batch_size):
+            yield (entry["ts"], entry["_id"]), format_statement_line(entry, leg)
+
+    def statement_page(self, card, start=None, end=None, after=None, page_size=STATEMENT_PAGE_SIZE):
+        # One page of statement lines plus the key to pass as `after` for the next page (None on the last)
+        lines = list(islice(self._statement_lines(card, start, end, after, page_size + 1), page_size + 1))
+        page = lines[:page_size]
+        next_key = page[-1][0] if len(lines) > page_size else None
+        return Result(True, "Statement", {"lines": [line for _, line in page], "next": next_key})
+
+    def export_statement(self, card, out, start=None, end=None):
+        # Streams the whole range to a text file object; only one cursor batch is in memory at a time
+        if not self.find_account(card, {"_id": 1}):
+            return Result(False, "Account not found")
+        out.write(f"Account statement for card {card}\nPeriod: {describe_period(start, end)}\n"
+                  f"Generated: {datetime.now():%Y-%m-%d %H:%M:%S}\n{'-' * 60}\n")
+        legacy = 0
+        for _, ts, line in self.legacy_history(card, start, end):
+            if not legacy:
+                out.write("History from before the ledger (its balance is carried over as the opening balance):\n")
+            out.write(format_legacy_line(ts, line) + "\n")
+            legacy += 1
+        if legacy:
+            out.write(f"{'-' * 60}\n")
+        count = credits = debits = 0
+        for entry, leg in self.ledger.statement(card, start, end):
+            out.write(format_statement_line(entry, leg) + "\n")
+            count += 1
+            if leg["amount"] > 0:
+                credits += leg["amount"]
+            else:
+                debits -= leg["amount"]
+        out.write(f"{'-' * 60}\nEntries: {count}  Credits: ${format_cents(credits)}  "
+                  f"Debits: ${format_cents(debits)}  Net: ${format_cents(credits - debits)}\n")
+        if legacy:
+            out.write(f"Pre-ledger history lines: {legacy} (not included in the totals)\n")
+        return Result(True, f"Exported {count + legacy} statement entries successfully", count + legacy)
+
+    @staticmethod
+    def _parse_amount(amount):
+        # Returns a positive amount in cents, 0 for non-positive amounts, None if unparseable
+        try:
+            cents = to_cents(amount)
+        except ValueError:
+            return None
+        return max(cents, 0)
+
+    def withdraw(self, card, amount, idempotency_key=None, allow_overdraft=False):
+        # allow_overdraft is only for replaying withdrawals a kiosk already paid out while offline
+        if is_system_account(card):
+            return Result(False, "Account not found")
+        cents = self._parse_amount(amount)
+        if cents is None:
+            return Result(False, "Invalid amount")
+        if not cents:
+            return Result(False, "Amount must be positive.")
+
+        # The funds check is part of the atomic seq claim, so concurrent withdrawals can't overdraw
+        shown = format_cents(cents)
+        if not self.ledger.post("withdraw", [(card, -cents, f"Withdrawn: ${shown}"),
+                                             (CASH_ACCOUNT, cents, f"Dispensed to {card}")],
+                                idempotency_key, allow_overdraft):
+            return Result(False, "Not enough balance")
+        return Result(True, f"Withdrawn ${shown}")
+
+    def deposit(self, card, amount, idempotency_key=None):
+        if is_system_account(card):
+            return Result(False, "Account not found")
+        cents = self._parse_amount(amount)
+        if cents is None:
+            return Result(False, "Invalid amount")
+        if not cents:
+            return Result(False, "Amount must be positive.")
+
+        shown = format_cents(cents)
+        if not self.ledger.post("deposit", [(CASH_ACCOUNT, -cents, f"Deposited by {card}"),
+                                            (card, cents, f"Deposited: ${shown}")], idempotency_key):
+            return Result(False, "Account not found")
+        return Result(True, f"Deposited ${shown}")
+
+    def transfer(self, sender, receiver, amount, idempotency_key=None):
+        if is_system_account(sender):
+            return Result(False, "Account not found")
+        cents = self._parse_amount(amount)
+        if cents is None:
+            return Result(False, "Invalid amount. Please enter a number.")
+        if not cents:
+            return Result(False, "Transfer amount must be positive.")
+        if receiver == sender:
+            return Result(False, "Cannot transfer to the same account.")
+        if not self.find_account(receiver, {"_id": 1}):
+            return Result(False, "Receiver card number does not exist.")
+
+        shown = format_cents(cents)
+        if not self.ledger.post("transfer", [(sender, -cents, f"Transferred ${shown} to {receiver}"),
+                                             (receiver, cents, f"Received ${shown} from {sender}")],
+                                idempotency_key):
+            return Result(False, "Insufficient funds for transfer.")
+        return Result(True, f"Transferred ${shown} to {receiver}")
+
+    def change_pin(self, card, old_pin, new_pin, confirm_pin):
+        user = self.find_account(card, {"pin": 1})
+        if not user or old_pin != user['pin']:
+            return Result(False, "Incorrect old PIN")
+        if not valid_pin(new_pin):
+            return Result(False, "New PIN must be 4 digits.")
+        if new_pin != confirm_pin:
+            return Result(False, "New PINs do not match")
+
+        self.accounts.update_one({"card": card}, {"$set": {"pin": new_pin}})
+        return Result(True, "PIN changed successfully")
+
+    # --- Batch mode ---
+    def apply_batch(self, ops):
+        # Applies a chunk of operations against one prefetch of the accounts it touches,
+        # then writes accounts and journal entries back with one grouped bulk_write each.
+        # If another writer changed one of those accounts meanwhile, the account writes that
+        # did land are undone before any journal entry is written, and the chunk is re-applied
+        # from a fresh prefetch; a chunk that keeps conflicting is reported as failed.
+        # Ops carrying a "_key" (see run_batch) post under it as their idempotency key, and keys
+        # already in the journal are skipped, so re-running a file doesn't apply it twice.
+        keys = [op["_key"] for op in ops if op.get("_key")]
+        for _ in range(BATCH_CONFLICT_RETRIES):
+            batch = _BatchState(self.accounts, ops, self.ledger.applied_keys(keys) if keys else set())
+            results = [batch.apply(op) for op in ops]
+            if not self._write_accounts(batch):
+                continue
+            try:
+                if batch.entries:
+                    self.ledger.journal.bulk_write([InsertOne(entry) for entry in batch.entries], ordered=False)
+            except pymongo.errors.PyMongoError as e:
+                # The account writes must not outlive their journal entries
+                self._undo_batch(batch)
+                if isinstance(e, BulkWriteError) and all(error.get("code") == 11000
+                                                         for error in e.details.get("writeErrors", [])):
+                    continue # Another runner applied some of these keys; the next prefetch skips them
+                raise
+            for card in batch.snapshot_due():
+                self.ledger.snapshot_account(card)
+            return results
+        return [Result(False, "Accounts changed during the batch; nothing was applied, retry later") for _ in ops]
+
+    def _write_accounts(self, batch):
+        # True if every guarded account write applied; otherwise rolls back the ones that did
+        account_requests = batch.account_requests()
+        if not account_requests:
+            return True
+        try:
+            written = self.accounts.bulk_write(account_requests, ordered=False)
+            if written.matched_count + written.inserted_count == len(account_requests):
+                return True
+        except BulkWriteError:
+            pass # e.g. a unique card index refused an account created concurrently
+        self._undo_accounts(batch)
+        return False
+
+    def _undo_accounts(self, batch):
+        undo = batch.undo_requests(self.accounts)
+        if undo:
+            undone = self.accounts.bulk_write(undo, ordered=False)
+            if undone.matched_count + undone.deleted_count != len(undo):
+                raise RuntimeError(f"{len(undo) - undone.matched_count - undone.deleted_count} batch account writes "
+                                   f"could not be undone; run 'python atm_ledger.py reconcile'")
+
+    def _undo_batch(self, batch):
+        # Journal entries that did land go first, so no leg is left pointing at an undone seq
+        self.ledger.journal.delete_many({"txn": {"$in": [entry["txn"] for entry in batch.entries]}})
+        self._undo_accounts(batch)
+
+    def run_batch(self, ops_file, results_file, batch_size=DEFAULT_BATCH_SIZE, source=None):
+        # Streams JSONL operations in fixed-size chunks, so memory stays flat for any file size.
+        # Each op is keyed by its "id" if it has one, else by the file's source hash and line number.
+        totals = {"ops": 0, "ok": 0, "failed": 0}
+        chunk = []
+        for line_no, line in enumerate(ops_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                op = json.loads(line)
+                if not isinstance(op, dict):
+                    raise ValueError("operation must be a JSON object")
+            except ValueError as e:
+                op = {"op": None, "error": f"Malformed operation: {e}"}
+            op["_line"] = line_no
+            if "id" in op:
+                op["_key"] = f"batch:{op['id']}"
+            elif source:
+                op["_key"] = f"batch:{source}:{line_no}"
+            chunk.append(op)
+            if len(chunk) >= batch_size:
+                self._flush_batch(chunk, results_file, totals)
+                chunk = []
+        if chunk:
+            self._flush_batch(chunk, results_file, totals)
+        return totals
+
+    def _flush_batch(self, chunk, results_file, totals):
+        results = self.apply_batch(chunk)
+        lines = []
+        for op, result in zip(chunk, results):
+            record = {"line": op["_line"], "op": op.get("op"), "ok": result.ok, "message": result.message}
+            if "id" in op:
+                record["id"] = op["id"]
+            if result.data is not None:
+                record["data"] = result.data
+            lines.append(json.dumps(record))
+            totals["ok" if result.ok else "failed"] += 1
+        totals["ops"] += len(chunk)
+        results_file.write("\n".join(lines) + "\n")
+
+
+class _NonPositiveAmount(ValueError):
+    pass
+
+
+class _BatchState:
+    # In-memory view of the accounts touched by one batch. Each card gets one UpdateOne
+    # ($inc of its balance_cents and ledger_seq, guarded by the prefetched seq), and new
+    # accounts are inserted with their final state.
+    def __init__(self, accounts_collection, ops, applied_keys=frozenset()):
+        cards = set()
+        for op in ops:
+            for key in ("card", "receiver"):
+                if isinstance(op.get(key), str) and not is_system_account(op[key]):
+                    cards.add(op[key])
+        self.accounts = {
+            doc["card"]: {"pin": doc["pin"], "balance": doc["balance_cents"], "seq": doc["ledger_seq"]}
+            for doc in accounts_collection.find({"card": {"$in": list(cards)}, "ledger_seq": {"$exists": True}},
+                                                {"_id": 0, "card": 1, "pin": 1, "balance_cents": 1, "ledger_seq": 1})
+        }
+        self.start = {card: (account["seq"], account["balance"]) for card, account in self.accounts.items()}
+        self.start_pins = {card: account["pin"] for card, account in self.accounts.items()}
+        self.inserted = {} # card -> document handed to InsertOne (pymongo fills in its _id)
+        self.batch_id = uuid.uuid4().hex
+        self.pins = {} # card -> new PIN
+        self.created = {} # card -> PIN of an account to insert
+        self.entries = []
+        self.applied_keys = applied_keys
+        self.keys = set() # Keys seen so far in this batch
+
+    def _post(self, kind, legs, key=None):
+        # legs: [(account, cents, memo)]; customer legs take the next seq of their account
+        posted = []
+        for account, cents, memo in legs:
+            seq = None
+            if account in self.accounts:
+                state = self.accounts[account]
+                state["balance"] += cents
+                state["seq"] += 1
+                seq = state["seq"]
+            posted.append((account, cents, seq, memo))
+        self.entries.append(Ledger.journal_entry(kind, posted, idempotency_key=key))
+
+    @staticmethod
+    def _cents(op):
+        cents = to_cents(op.get("amount"))
+        if cents <= 0:
+            raise _NonPositiveAmount()
+        return cents
+
+    def apply(self, op):
+        if op.get("error"):
+            return Result(False, op["error"])
+        name = op.get("op")
+        handler = getattr(self, f"_op_{name}", None) if isinstance(name, str) else None
+        if handler is None:
+            return Result(False, f"Unknown operation: {name}")
+        key = op.get("_key")
+        if key in self.applied_keys:
+            return Result(True, "Already applied")
+        if key:
+            if key in self.keys:
+                return Result(False, "Duplicate operation id")
+            self.keys.add(key)
+        card = op.get("card")
+        if name != "create_account" and (not isinstance(card, str) or card not in self.accounts):
+            return Result(False, "Account not found")
+        try:
+            return handler(op)
+        except _NonPositiveAmount:
+            return Result(False, "Transfer amount must be positive." if name == "transfer" else "Amount must be positive.")
+        except (TypeError, ValueError):
+            return Result(False, "Invalid amount")
+
+    def _op_create_account(self, op):
+        card, pin = op.get("card"), op.get("pin")
+        if not card or not isinstance(card, str):
+            return Result(False, "Card number cannot be empty.")
+        if card in self.accounts or is_system_account(card):
+            return Result(False, "Card number already exists. Please choose another.")
+        if not isinstance(pin, str) or not valid_pin(pin):
+            return Result(False, "PIN must be 4 digits.")
+        self.created[card] = pin
+        self.accounts[card] = {"pin": pin, "balance": 0, "seq": 0}
+        return Result(True, "Account created successfully!")
+
+    def _op_authenticate(self, op):
+        if self.accounts[op["card"]]["pin"] == op.get("pin"):
+            return Result(True, "Login successful")
+        return Result(False, "Invalid Card Number or PIN")
+
+    def _op_balance(self, op):
+        cents = self.accounts[op["card"]]["balance"]
+        return Result(True, f"Current Balance: ${format_cents(cents)}", cents)
+
+    def _op_deposit(self, op):
+        card, cents = op["card"], self._cents(op)
+        shown = format_cents(cents)
+        self._post("deposit", [(CASH_ACCOUNT, -cents, f"Deposited by {card}"),
+                               (card, cents, f"Deposited: ${shown}")], op.get("_key"))
+        return Result(True, f"Deposited ${shown}")
+
+    def _op_withdraw(self, op):
+        card, cents = op["card"], self._cents(op)
+        if self.accounts[card]["balance"] < cents:
+            return Result(False, "Not enough balance")
+        shown = format_cents(cents)
+        self._post("withdraw", [(card, -cents, f"Withdrawn: ${shown}"),
+                                (CASH_ACCOUNT, cents, f"Dispensed to {card}")], op.get("_key"))
+        return Result(True, f"Withdrawn ${shown}")
+
+    def _op_transfer(self, op):
+        sender, receiver = op["card"], op.get("receiver")
+        cents = self._cents(op)
+        if receiver == sender:
+            return Result(False, "Cannot transfer to the same account.")
+        if receiver not in self.accounts:
+            return Result(False, "Receiver card number does not exist.")
+        if self.accounts[sender]["balance"] < cents:
+            return Result(False, "Insufficient funds for transfer.")
+        shown = format_cents(cents)
+        self._post("transfer", [(sender, -cents, f"Transferred ${shown} to {receiver}"),
+                                (receiver, cents, f"Received ${shown} from {sender}")], op.get("_key"))
+        return Result(True, f"Transferred ${shown} to {receiver}")
+
+    def _op_change_pin(self, op):
+        card, new_pin = op["card"], op.get("new_pin")
+        if op.get("old_pin") != self.accounts[card]["pin"]:
+            return Result(False, "Incorrect old PIN")
+        if not isinstance(new_pin, str) or not valid_pin(new_pin):
+            return Result(False, "New PIN must be 4 digits.")
+        if new_pin != op.get("confirm_pin", new_pin):
+            return Result(False, "New PINs do not match")
+        self.accounts[card]["pin"] = new_pin
+        if card in self.created:
+            self.created[card] = new_pin
+        else:
+            self.pins[card] = new_pin
+        return Result(True, "PIN changed successfully")
+
+    def account_requests(self):
+        requests = []
+        for card in self.created:
+            state = self.accounts[card]
+            self.inserted[card] = {"card": card, "pin": state["pin"],
+                                   "balance_cents": state["balance"], "ledger_seq": state["seq"]}
+            requests.append(InsertOne(self.inserted[card]))
+        for card, (start_seq, start_balance) in self.start.items():
+            state = self.accounts[card]
+            update = {}
+            if state["seq"] != start_seq:
+                update["$inc"] = {"ledger_seq": state["seq"] - start_seq,
+                                  "balance_cents": state["balance"] - start_balance}
+            if card in self.pins:
+                update["$set"] = {"pin": self.pins[card]}
+            if update:
+                # The batch tag tells undo_requests this write landed; a seq match alone could be another writer's
+                update.setdefault("$set", {})["last_batch"] = self.batch_id
+                requests.append(UpdateOne({"card": card, "ledger_seq": start_seq}, update))
+        return requests
+
+    def undo_requests(self, accounts_collection):
+        # Inverse writes for the account requests that landed, recognised by this batch's tag
+        requests = []
+        for doc in accounts_collection.find({"card": {"$in": list(self.start)}, "last_batch": self.batch_id},
+                                            {"_id": 0, "card": 1}):
+            card = doc["card"]
+            state, (start_seq, start_balance) = self.accounts[card], self.start[card]
+            undo = {"$unset": {"last_batch": ""}}
+            if state["seq"] != start_seq:
+                undo["$inc"] = {"ledger_seq": start_seq - state["seq"], "balance_cents": start_balance - state["balance"]}
+            if card in self.pins:
+                undo["$set"] = {"pin": self.start_pins[card]}
+            # Guarded on the final seq: if another posting followed, the seqs can't be handed back
+            requests.append(UpdateOne({"card": card, "ledger_seq": state["seq"], "last_batch": self.batch_id}, undo))
+        inserted_ids = [doc["_id"] for doc in self.inserted.values() if "_id" in doc]
+        for doc in accounts_collection.find({"_id": {"$in": inserted_ids}}, {"_id": 1}):
+            requests.append(DeleteOne({"_id": doc["_id"]}))
+        return requests
+
+    def snapshot_due(self):
+        # Cards whose seq crossed a SNAPSHOT_EVERY boundary during this batch
+        return [card for card, state in self.accounts.items()
+                if state["seq"] // SNAPSHOT_EVERY > self.start.get(card, (0, 0))[0] // SNAPSHOT_EVERY]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a JSONL file of ATM operations without the GUI.")
+    parser.add_argument("ops", help="JSONL operations file, one {\"op\": ..., \"card\": ...} object per line ('-' for stdin)")
+    parser.add_argument("results", help="JSONL results file to write ('-' for stdout)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--mongo-uri", default=DEFAULT_MONGO_URI)
+    parser.add_argument("--db", default="atm_system")
+    args = parser.parse_args(argv)
+
+    source = None
+    if args.ops != "-":
+        # Ops without an "id" are keyed by this hash and their line, so re-running the same file is a no-op
+        digest = hashlib.sha256()
+        with open(args.ops, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        source = digest.hexdigest()[:16]
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    engine = ATMEngine(client[args.db])
+    engine.prepare()
+
+    ops_file = sys.stdin if args.ops == "-" else open(args.ops, 'r')
+    results_file = sys.stdout if args.results == "-" else open(args.results, 'w')
+    try:
+        start = time.perf_counter()
+        totals = engine.run_batch(ops_file, results_file, args.batch_size, source)
+        elapsed = time.perf_counter() - start
+    finally:
+        if ops_file is not sys.stdin:
+            ops_file.close()
+        if results_file is not sys.stdout:
+            results_file.close()
+
+    rate = totals["ops"] / elapsed if elapsed else 0.0
+    print(f"Applied {totals['ops']} operations ({totals['ok']} ok, {totals['failed']} failed) "
+          f"in {elapsed:.2f}s, {rate:.0f} ops/s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+import argparse
+import sys
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+import pymongo
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+# System accounts start with "@"; they balance customer postings but have no seq or snapshots
+CASH_ACCOUNT = "@cash" # Cash physically deposited into / dispensed by the kiosks
+OPENING_BALANCE_ACCOUNT = "@opening" # Balances carried over from before the ledger existed
+SUSPENSE_ACCOUNT = "@suspense" # Parks half-applied postings until they are reversed
+
+SNAPSHOT_EVERY = 100 # Take a balance snapshot every N postings to an account
+CLAIMED_KEYS_KEPT = 100 # Recent idempotency keys remembered on each account, with the seq they claimed
+INTENT_GRACE = timedelta(minutes=5) # A pending posting older than this is assumed abandoned by its kiosk
+STATEMENT_BATCH_SIZE = 500 # Journal entries fetched per cursor round-trip when streaming statements
+MAX_AMOUNT = Decimal("1000000000") # Largest single amount accepted; keeps cents far inside MongoDB's 64-bit ints
+
+# Journal entry "state" while a posting is in progress; finished entries have no state
+INTENT_PENDING = "pending" # Written before any seq is claimed; not part of the ledger yet
+INTENT_FAILED = "failed" # Claimed legs booked against suspense, reversals still to post
+INTENT_REVERSED = "reversed" # Failed entry whose reversals are all posted
+
+
+def to_cents(amount):
+    try:
+        value = Decimal(str(amount).strip())
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"Invalid amount: {amount!r}")
+    if not value.is_finite() or abs(value) > MAX_AMOUNT:
+        raise ValueError(f"Invalid amount: {amount!r}")
+    return int((value * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def is_system_account(account):
+    return account.startswith("@")
+
+
+def format_entry_line(entry, leg):
+    return f"{entry['ts']:%Y-%m-%d %H:%M:%S} - {leg['memo']}"
+
+
+def format_statement_line(entry, leg):
+    amount = ("+" if leg["amount"] > 0 else "") + format_cents(leg["amount"])
+    return f"{entry['ts']:%Y-%m-%d %H:%M:%S}  {amount:>12}  {leg['memo']}"
+
+
+# --- Double-entry Ledger ---
+class Ledger:
+    # Append-only journal in integer cents. Every journal entry holds legs that sum to zero;
+    # each customer leg carries that account's next gap-free seq number. Account documents keep
+    # balance_cents and ledger_seq only as the atomic funds guard and seq allocator.
+    # A posting is first written as a pending intent, so an interrupted one can always be
+    # found and either completed or reversed (see repair_incomplete).
+    def __init__(self, db):
+        self.accounts = db["accounts"]
+        self.journal = db["ledger"]
+        self.snapshots = db["balance_snapshots"]
+
+    def ensure_indexes(self):
+        self._ensure_unique_cards()
+        self.journal.create_index([("legs.account", 1), ("legs.seq", 1)])
+        self.journal.create_index([("legs.account", 1), ("ts", 1)])
+        self.snapshots.create_index([("account", 1), ("seq", -1)])
+        self.journal.create_index("idem", unique=True, sparse=True)
+        self.journal.create_index("state", sparse=True)
+
+    def _ensure_unique_cards(self):
+        # One account document per card. Databases from before this have a non-unique card index,
+        # which is rebuilt once. Duplicate cards can't be merged automatically: warm-up stops and
+        # names them, and the kiosk stays out of service until an operator resolves them.
+        for attempt in range(2):
+            try:
+                self.accounts.create_index("card", unique=True)
+                return
+            except OperationFailure as e:
+                if e.code == 11000:
+                    raise RuntimeError(f"Duplicate card numbers {self.duplicate_cards()}; "
+                                       f"merge or remove them, then restart") from e
+                if attempt or "card_1" not in self.accounts.index_information():
+                    raise
+                self.accounts.drop_index("card_1")
+
+    def duplicate_cards(self):
+        return sorted(group["_id"] for group in self.accounts.aggregate([
+            {"$group": {"_id": "$card", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]))
+
+    def migrate_legacy_accounts(self):
+        # Accounts created before the ledger have a float balance and no seq; open them with one entry.
+        # An account whose balance can't be parsed is left unmigrated (reconcile reports it).
+        migrated = 0
+        for account in self.accounts.find({"ledger_seq": {"$exists": False}}, {"card": 1, "balance": 1}):
+            try:
+                migrated += self._migrate_account(account)
+            except ValueError as e:
+                print(f"Warning: not migrating {account.get('card')!r}: {e}", file=sys.stderr)
+        return migrated
+
+    def _migrate_account(self, account):
+        cents = to_cents(account.get("balance", 0.0))
+        claimed = self.accounts.update_one(
+            {"_id": account["_id"], "ledger_seq": {"$exists": False}},
+            {"$set": {"ledger_seq": 1, "balance_cents": cents}, "$unset": {"balance": ""}}
+        )
+        if not claimed.modified_count:
+            return False # Another kiosk got there first
+        self.journal.insert_one(self.journal_entry("opening_balance", [
+            (account["card"], cents, 1, "Opening balance carried over"),
+            (OPENING_BALANCE_ACCOUNT, -cents, None, f"Opening balance of {account['card']}"),
+        ]))
+        return True
+
+    def _migrate_on_demand(self, account):
+        # Lets a posting reach a legacy account before migrate_legacy_accounts has run
+        legacy = self.accounts.find_one({"card": account, "ledger_seq": {"$exists": False}}, {"card": 1, "balance": 1})
+        if not legacy:
+            return False
+        try:
+            self._migrate_account(legacy)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def _legs(legs):
+        # legs: [(account, cents, seq, memo)]
+        return [{"account": account, "amount": cents, "seq": seq, "memo": memo} for account, cents, seq, memo in legs]
+
+    @staticmethod
+    def journal_entry(kind, legs, ts=None, idempotency_key=None):
+        # legs: [(account, cents, seq, memo)]
+        entry = {
+            "txn": uuid.uuid4().hex,
+            "kind": kind,
+            "ts": ts or datetime.now(),
+            "legs": Ledger._legs(legs),
+        }
+        if idempotency_key:
+            entry["idem"] = idempotency_key
+        return entry
+
+    def applied_keys(self, keys):
+        # Keys of finished postings; pending or failed ones still need (or can't get) a replay
+        return {entry["idem"] for entry in self.journal.find({"idem": {"$in": list(keys)}, "state": {"$exists": False}},
+                                                             {"idem": 1})}
+
+    def _claim_seq(self, account, cents, allow_overdraft, key):
+        # The key and its seq are pushed in the same update that moves the balance, so resuming
+        # a posting whose claim landed reuses that seq instead of charging the account again.
+        # $inc can't report the seq it produced, hence compare-and-set.
+        if is_system_account(account):
+            return None # Never let a customer document shadow a system account
+        while True:
+            doc = self.accounts.find_one({"card": account, "ledger_seq": {"$exists": True}},
+                                         {"ledger_seq": 1, "balance_cents": 1, "claimed_keys": 1})
+            if doc is None:
+                if self._migrate_on_demand(account):
+                    continue
+                return None
+            for claim in doc.get("claimed_keys", []):
+                if claim["key"] == key:
+                    return claim["seq"]
+            if cents < 0 and not allow_overdraft and doc["balance_cents"] < -cents:
+                return None
+            seq = doc["ledger_seq"] + 1
+            claimed = self.accounts.update_one(
+                {"card": account, "ledger_seq": doc["ledger_seq"]},
+                {"$set": {"ledger_seq": seq}, "$inc": {"balance_cents": cents},
+                 "$push": {"claimed_keys": {"$each": [{"key": key, "seq": seq}], "$slice": -CLAIMED_KEYS_KEPT}}}
+            )
+            if claimed.modified_count:
+                return seq
+
+    def _claimed_seq(self, account, key):
+        # The seq a posting under key already claimed on account, without claiming one
+        doc = self.accounts.find_one({"card": account, "claimed_keys.key": key}, {"claimed_keys": 1})
+        for claim in doc.get("claimed_keys", []) if doc else []:
+            if claim["key"] == key:
+                return claim["seq"]
+        return None
+
+    def post(self, kind, legs, idempotency_key=None, allow_overdraft=False):
+        # legs: [(account, cents, memo)] summing to zero, customer debits first. Returns the
+        # journal entry, or None if a customer account is missing or lacks the funds. An entry
+        # already posted under idempotency_key is returned as-is instead of being posted again,
+        # and a replay of a posting that was interrupted resumes it.
+        if sum(cents for _, cents, _ in legs) != 0:
+            raise ValueError(f"Unbalanced {kind} entry: {legs}")
+        if idempotency_key:
+            existing = self.journal.find_one({"idem": idempotency_key})
+            if existing:
+                return self._resume(existing, allow_overdraft)
+
+        # Every posting gets a key: the intent is journaled before any seq is claimed under it
+        intent = self.journal_entry(kind, [(account, cents, None, memo) for account, cents, memo in legs],
+                                    idempotency_key=idempotency_key or uuid.uuid4().hex)
+        intent["state"] = INTENT_PENDING
+        try:
+            self.journal.insert_one(intent)
+        except DuplicateKeyError:
+            # A concurrent replay of the same key got there first
+            return self._resume(self.journal.find_one({"idem": idempotency_key}), allow_overdraft)
+        return self._complete(intent, allow_overdraft)
+
+    def _resume(self, entry, allow_overdraft):
+        state = entry.get("state") if entry else INTENT_FAILED
+        if state is None:
+            return entry
+        if state == INTENT_PENDING:
+            return self._complete(entry, allow_overdraft)
+        return None # This key already failed and was reversed
+
+    def _complete(self, intent, allow_overdraft):
+        posted = []
+        for leg in intent["legs"]:
+            account, cents, memo = leg["account"], leg["amount"], leg["memo"]
+            seq = None
+            if not is_system_account(account):
+                seq = self._claim_seq(account, cents, allow_overdraft, intent["idem"])
+                if seq is None:
+                    self._fail(intent, posted)
+                    return None
+            posted.append((account, cents, seq, memo))
+        return self._finish(intent, posted)
+
+    def _finish(self, intent, posted):
+        finished = self.journal.update_one({"_id": intent["_id"], "state": INTENT_PENDING},
+                                           {"$set": {"legs": self._legs(posted)}, "$unset": {"state": ""}})
+        if not finished.matched_count:
+            # Completed or failed by another replay or a repair meanwhile
+            return self._resume(self.journal.find_one({"_id": intent["_id"]}), False)
+        self._snapshot_due(posted)
+        entry = dict(intent, legs=self._legs(posted))
+        del entry["state"]
+        return entry
+
+    def _fail(self, intent, posted):
+        # An intent that claimed nothing is simply dropped. Legs that did claim a seq must reach
+        # the journal: the intent becomes a failed entry against suspense, which is then reversed.
+        claimed = [leg for leg in posted if leg[2] is not None]
+        if not claimed:
+            self.journal.delete_one({"_id": intent["_id"], "state": INTENT_PENDING})
+            return
+        parked = sum(cents for _, cents, _, _ in claimed)
+        failed = dict(intent, kind=f"{intent['kind']}_failed", state=INTENT_FAILED,
+                      legs=self._legs(claimed + [(SUSPENSE_ACCOUNT, -parked, None, f"Incomplete {intent['kind']}")]))
+        if self.journal.update_one({"_id": intent["_id"], "state": INTENT_PENDING},
+                                   {"$set": {key: failed[key] for key in ("kind", "state", "legs")}}).matched_count:
+            self._reverse(failed)
+
+    def _reverse(self, failed):
+        # Reversal keys derive from the failed entry's key, so reversing twice posts each one once
+        kind = failed["kind"].removesuffix("_failed")
+        for leg in failed["legs"]:
+            account, cents = leg["account"], leg["amount"]
+            if is_system_account(account):
+                continue
+            # The reversal must land even if the money was spent meanwhile
+            self.post(f"{kind}_reversal", [(account, -cents, f"Reversed: {leg['memo']}"),
+                                           (SUSPENSE_ACCOUNT, cents, f"Reversed {kind} for {account}")],
+                      f"{failed['idem']}:reversal:{account}", allow_overdraft=True)
+        self.journal.update_one({"_id": failed["_id"], "state": INTENT_FAILED}, {"$set": {"state": INTENT_REVERSED}})
+
+    def repair_incomplete(self, grace=INTENT_GRACE):
+        # Postings whose kiosk died mid-way: a pending intent older than grace is completed if every
+        # customer leg claimed its seq, and otherwise has its claims reversed; failed entries whose
+        # reversals didn't all land get them posted. Returns the number of entries repaired.
+        repaired = 0
+        for intent in self.journal.find({"state": INTENT_PENDING, "ts": {"$lte": datetime.now() - grace}}):
+            posted = [(leg["account"], leg["amount"],
+                       None if is_system_account(leg["account"]) else self._claimed_seq(leg["account"], intent["idem"]),
+                       leg["memo"]) for leg in intent["legs"]]
+            if all(seq is not None for account, _, seq, _ in posted if not is_system_account(account)):
+                self._finish(intent, posted)
+            else:
+                self._fail(intent, posted)
+            repaired += 1
+        for failed in self.journal.find({"state": INTENT_FAILED}):
+            self._reverse(failed)
+            repaired += 1
+        return repaired
+
+    def _snapshot_due(self, posted):
+        for account, _, seq, _ in posted:
+            if seq and seq % SNAPSHOT_EVERY == 0:
+                self.snapshot_account(account)
+
+    def latest_snapshot(self, account):
+        return self.snapshots.find_one({"account": account}, sort=[("seq", -1)])
+
+    def legs_since(self, account, seq):
+        for entry in self.journal.find({"legs": {"$elemMatch": {"account": account, "seq": {"$gt": seq}}}}):
+            for leg in entry["legs"]:
+                if leg["account"] == account and leg["seq"] > seq:
+                    yield entry, leg
+
+    def balance(self, account):
+        # Latest snapshot plus at most SNAPSHOT_EVERY legs written since
+        snapshot = self.latest_snapshot(account)
+        seq, cents = (snapshot["seq"], snapshot["balance"]) if snapshot else (0, 0)
+        for _, leg in self.legs_since(account, seq):
+            cents += leg["amount"]
+        return cents
+
+    def snapshot_account(self, account):
+        snapshot = self.latest_snapshot(account)
+        seq, cents = (snapshot["seq"], snapshot["balance"]) if snapshot else (0, 0)
+        start_seq = seq
+        for leg_seq, amount in sorted((leg["seq"], leg["amount"]) for _, leg in self.legs_since(account, seq)):
+            if leg_seq != seq + 1:
+                break # A posting is still in flight; only snapshot the gap-free prefix
+            seq, cents = leg_seq, cents + amount
+        if seq == start_seq:
+            return False
+        self.snapshots.insert_one({"account": account, "seq": seq, "balance": cents, "ts": datetime.now()})
+        return True
+
+    def snapshot_all(self):
+        return sum(1 for account in self.accounts.find({}, {"card": 1}) if self.snapshot_account(account["card"]))
+
+    def statement(self, account, start=None, end=None, after=None, batch_size=STATEMENT_BATCH_SIZE):
+        # Yields (entry, leg) for the account in time order over [start, end), resuming after the
+        # (ts, _id) key of a previous page. The cursor fetches fixed-size batches, so memory stays flat.
+        query = {"legs.account": account, "state": {"$ne": INTENT_PENDING}}
+        ts_range = {}
+        if start:
+            ts_range["$gte"] = start
+        if end:
+            ts_range["$lt"] = end
+        if ts_range:
+            query["ts"] = ts_range
+        if after:
+            after_ts, after_id = after
+            query["$or"] = [{"ts": {"$gt": after_ts}}, {"ts": after_ts, "_id": {"$gt": after_id}}]
+        cursor = self.journal.find(query).sort([("ts", 1), ("_id", 1)]).batch_size(batch_size)
+        for entry in cursor:
+            for leg in entry["legs"]:
+                if leg["account"] == account:
+                    yield entry, leg
+
+    def reconcile(self):
+        # Streams the journal once. Every entry must balance; each account's legs must form a
+        # gap-free 1..ledger_seq run that sums to its balance_cents and agrees with its latest snapshot.
+        problems = []
+        accounts = {}
+        for doc in self.accounts.find({}, {"card": 1, "balance_cents": 1, "ledger_seq": 1}):
+            if doc["card"] in accounts:
+                problems.append(f"{doc['card']}: more than one account document")
+            accounts[doc["card"]] = doc
+        snapshots = {}
+        for snapshot in self.snapshots.find({}, {"account": 1, "seq": 1, "balance": 1}):
+            current = snapshots.get(snapshot["account"])
+            if current is None or snapshot["seq"] > current["seq"]:
+                snapshots[snapshot["account"]] = snapshot
+
+        totals = {} # account -> [sum, leg count, max seq, sum up to snapshot seq]
+        system_totals = {}
+        entries = 0
+        stale = datetime.now() - INTENT_GRACE
+        for entry in self.journal.find({}, {"txn": 1, "kind": 1, "ts": 1, "legs": 1, "state": 1}):
+            if entry.get("state") == INTENT_PENDING:
+                # In flight; its claims show up as seq/balance drift until it completes
+                if entry["ts"] < stale:
+                    problems.append(f"Entry {entry['txn']} is an unfinished {entry['kind']}; "
+                                    f"run 'python atm_ledger.py repair'")
+                continue
+            entries += 1
+            if sum(leg["amount"] for leg in entry["legs"]) != 0:
+                problems.append(f"Entry {entry['txn']} does not balance")
+            for leg in entry["legs"]:
+                account = leg["account"]
+                if is_system_account(account):
+                    system_totals[account] = system_totals.get(account, 0) + leg["amount"]
+                    continue
+                total = totals.setdefault(account, [0, 0, 0, 0])
+                total[0] += leg["amount"]
+                total[1] += 1
+                total[2] = max(total[2], leg["seq"])
+                snapshot = snapshots.get(account)
+                if snapshot and leg["seq"] <= snapshot["seq"]:
+                    total[3] += leg["amount"]
+
+        for card in sorted(set(accounts) | set(totals)):
+            account = accounts.get(card)
+            cents, count, max_seq, snapshot_sum = totals.get(card, [0, 0, 0, 0])
+            if account is None:
+                problems.append(f"{card}: ledger legs for an unknown account")
+                continue
+            if "ledger_seq" not in account:
+                problems.append(f"{card}: not migrated to the ledger")
+                continue
+            if count != max_seq or max_seq != account["ledger_seq"]:
+                problems.append(f"{card}: {count} legs but seq {max_seq}, account at seq {account['ledger_seq']}")
+            if cents != account["balance_cents"]:
+                problems.append(f"{card}: ledger total {format_cents(cents)} != balance {format_cents(account['balance_cents'])}")
+            snapshot = snapshots.get(card)
+            if snapshot and snapshot_sum != snapshot["balance"]:
+                problems.append(f"{card}: snapshot at seq {snapshot['seq']} is {format_cents(snapshot['balance'])}, "
+                                f"ledger says {format_cents(snapshot_sum)}")
+        if system_totals.get(SUSPENSE_ACCOUNT, 0):
+            problems.append(f"Suspense holds {format_cents(system_totals[SUSPENSE_ACCOUNT])}")
+
+        return {"entries": entries, "accounts": len(accounts), "system_totals": system_totals, "problems": problems}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ATM ledger maintenance.")
+    parser.add_argument("command", choices=["migrate", "snapshot", "repair", "reconcile"])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--db", default="atm_system")
+    args = parser.parse_args(argv)
+
+    ledger = Ledger(pymongo.MongoClient(args.mongo_uri)[args.db])
+    ledger.ensure_indexes()
+    if args.command == "migrate":
+        print(f"Migrated {ledger.migrate_legacy_accounts()} legacy accounts")
+    elif args.command == "snapshot":
+        print(f"Snapshotted {ledger.snapshot_all()} accounts")
+    elif args.command == "repair":
+        print(f"Repaired {ledger.repair_incomplete()} unfinished postings")
+    else:
+        report = ledger.reconcile()
+        for problem in report["problems"]:
+            print(problem)
+        print(f"Checked {report['entries']} entries across {report['accounts']} accounts: "
+              f"{len(report['problems'])} problems")
+        return 1 if report["problems"] else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
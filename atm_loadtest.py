@@ -0,0 +1,343 @@
+import argparse
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from atm_engine import ATMEngine, DEFAULT_MONGO_URI
+from atm_ledger import to_cents, format_cents
+
+UpdateResult = namedtuple("UpdateResult", ["matched_count", "modified_count"])
+
+# Relative weights of what a kiosk session does after logging in
+DEFAULT_MIX = {"withdraw": 30, "deposit": 30, "transfer": 25, "mini_statement": 15}
+LOADTEST_DB = "atm_loadtest"
+
+# Field each stand-in collection is indexed on, as a lookup key taken from a document or a query
+INDEXES = {
+    "accounts": (lambda doc: [doc.get("card")],
+                 lambda query: query.get("card")),
+    "ledger": (lambda doc: [leg["account"] for leg in doc.get("legs", [])],
+               lambda query: query.get("legs.account") or query.get("legs", {}).get("$elemMatch", {}).get("account")),
+    "balance_snapshots": (lambda doc: [doc.get("account")],
+                          lambda query: query.get("account")),
+}
+
+
+# --- In-process stand-in for the ATM database ---
+class InMemoryDatabase:
+    # Just enough of a pymongo Database for ATMEngine's single-operation methods and the
+    # ledger; all collections share one lock, like a single-node mongod under light load.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = InMemoryCollection(self.lock, *INDEXES.get(name, (None, None)))
+        return self.collections[name]
+
+
+class _Cursor(list):
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            super().sort(key=lambda doc: doc.get(field), reverse=order < 0)
+        return self
+
+    def limit(self, count):
+        return _Cursor(self[:count]) if count else self
+
+    def batch_size(self, size):
+        return self
+
+
+def _match_value(value, condition):
+    if not isinstance(condition, dict):
+        return value == condition
+    for op, operand in condition.items():
+        if op == "$exists":
+            if (value is not None) != operand:
+                return False
+        elif op == "$ne":
+            if value == operand:
+                return False
+        elif op == "$elemMatch":
+            if not any(_matches(item, operand) for item in value or []):
+                return False
+        elif value is None:
+            return False
+        elif op == "$in" and value not in operand:
+            return False
+        elif (op == "$gt" and not value > operand) or (op == "$gte" and not value >= operand) \
+                or (op == "$lt" and not value < operand) or (op == "$lte" and not value <= operand):
+            return False
+    return True
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(doc, clause) for clause in condition):
+                return False
+        elif "." in key:
+            # Dotted path into an array of sub-documents matches if any element does
+            field, sub_field = key.split(".", 1)
+            if not any(_match_value(item.get(sub_field), condition) for item in doc.get(field) or []):
+                return False
+        elif not _match_value(doc.get(key), condition):
+            return False
+    return True
+
+
+class InMemoryCollection:
+    def __init__(self, lock, doc_keys=None, query_key=None):
+        self._lock = lock
+        self._doc_keys = doc_keys
+        self._query_key = query_key
+        self._docs = {} # _id -> document
+        self._index = {} # indexed value -> {_id: document}
+        self._next_id = 0
+
+    def _candidates(self, query):
+        key = self._query_key(query) if self._query_key else None
+        if isinstance(key, str):
+            return list(self._index.get(key, {}).values())
+        return list(self._docs.values())
+
+    @staticmethod
+    def _project(doc, projection):
+        doc = dict(doc)
+        if projection and isinstance(projection.get("transactions"), dict):
+            doc["transactions"] = doc.get("transactions", [])[projection["transactions"]["$slice"]:]
+        return doc
+
+    def _find(self, query, projection=None):
+        return [self._project(doc, projection) for doc in self._candidates(query) if _matches(doc, query)]
+
+    def find(self, query=None, projection=None):
+        with self._lock:
+            return _Cursor(self._find(query or {}, projection))
+
+    def find_one(self, query, projection=None, sort=None):
+        with self._lock:
+            found = _Cursor(self._find(query, projection))
+        if sort:
+            found.sort(sort)
+        return found[0] if found else None
+
+    def _keys(self, doc):
+        return set(self._doc_keys(doc)) if self._doc_keys else set()
+
+    def insert_one(self, document):
+        with self._lock:
+            self._next_id += 1
+            document.setdefault("_id", self._next_id)
+            self._docs[document["_id"]] = dict(document)
+            for key in self._keys(document):
+                self._index.setdefault(key, {})[document["_id"]] = self._docs[document["_id"]]
+
+    def delete_one(self, query):
+        with self._lock:
+            for doc in self._candidates(query):
+                if _matches(doc, query):
+                    del self._docs[doc["_id"]]
+                    for key in self._keys(doc):
+                        del self._index[key][doc["_id"]]
+                    return
+
+    def create_index(self, keys, **kwargs):
+        pass
+
+    @staticmethod
+    def _apply_update(doc, update):
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        for field, value in update.get("$push", {}).items():
+            values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            doc.setdefault(field, []).extend(values)
+            if isinstance(value, dict) and "$slice" in value:
+                doc[field] = doc[field][value["$slice"]:]
+        for field, condition in update.get("$pull", {}).items():
+            doc[field] = [item for item in doc.get(field, []) if not _matches(item, condition)]
+        doc.update(update.get("$set", {}))
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+
+    def update_one(self, query, update):
+        with self._lock:
+            for doc in self._candidates(query):
+                if _matches(doc, query):
+                    before = self._keys(doc)
+                    self._apply_update(doc, update)
+                    # e.g. a failed ledger intent whose legs are replaced
+                    for key in before - self._keys(doc):
+                        del self._index[key][doc["_id"]]
+                    for key in self._keys(doc) - before:
+                        self._index.setdefault(key, {})[doc["_id"]] = doc
+                    return UpdateResult(1, 1)
+        return UpdateResult(0, 0)
+
+    def find_one_and_update(self, query, update, projection=None, return_document=None):
+        # Always returns the document after the update (ReturnDocument.AFTER)
+        with self._lock:
+            for doc in self._candidates(query):
+                if _matches(doc, query):
+                    self._apply_update(doc, update)
+                    return self._project(doc, projection)
+        return None
+
+
+# --- Load test ---
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def total_balance(accounts_collection):
+    return sum(doc["balance_cents"] for doc in accounts_collection.find({}, {"balance_cents": 1}))
+
+
+def seed_accounts(engine, count, initial_balance):
+    cards = [f"LT{i:06d}" for i in range(count)]
+    for card in cards:
+        engine.create_account(card, "1234")
+        engine.deposit(card, initial_balance)
+    return cards
+
+
+def run_session(engine, cards, ops, mix, seed, stats):
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    card = rng.choice(cards)
+    latencies = {}
+    net_cash = 0 # Cents that entered (+) or left (-) the system through this session
+    errors = 0
+
+    def timed(name, func, *args):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            errors += 1
+            result = None
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    timed("authenticate", engine.authenticate, card, "1234")
+    for _ in range(ops):
+        name = rng.choices(names, weights)[0]
+        amount = rng.randint(1, 20000) / 100.0
+        if name == "withdraw":
+            result = timed(name, engine.withdraw, card, amount)
+            if result and result.ok:
+                net_cash -= to_cents(amount)
+        elif name == "deposit":
+            result = timed(name, engine.deposit, card, amount)
+            if result and result.ok:
+                net_cash += to_cents(amount)
+        elif name == "transfer":
+            timed(name, engine.transfer, card, rng.choice(cards), amount)
+        else:
+            timed(name, engine.mini_statement, card)
+
+    with stats["lock"]:
+        for name, values in latencies.items():
+            stats["latencies"].setdefault(name, []).extend(values)
+        stats["net_cash"] += net_cash
+        stats["errors"] += errors
+
+
+def run_load_test(db, sessions, ops_per_session, account_count,
+                  initial_balance=1000.0, mix=None, seed=0):
+    engine = ATMEngine(db)
+    engine.prepare()
+    cards = seed_accounts(engine, account_count, initial_balance)
+    opening_total = total_balance(engine.accounts)
+
+    stats = {"lock": threading.Lock(), "latencies": {}, "net_cash": 0, "errors": 0}
+    threads = [threading.Thread(target=run_session,
+                                args=(engine, cards, ops_per_session, mix or DEFAULT_MIX, seed + i, stats))
+               for i in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    closing_total = total_balance(engine.accounts)
+    expected_total = opening_total + stats["net_cash"]
+    negative = [doc["card"] for doc in engine.accounts.find({"balance_cents": {"$lt": 0}}, {"card": 1})]
+    return {
+        "elapsed": elapsed,
+        "latencies": {name: sorted(values) for name, values in stats["latencies"].items()},
+        "errors": stats["errors"],
+        "opening_total": opening_total,
+        "closing_total": closing_total,
+        "expected_total": expected_total,
+        "conserved": closing_total == expected_total,
+        "negative_accounts": negative,
+        # The ledger must also agree with itself: balanced entries, gap-free seqs, matching snapshots
+        "ledger_problems": engine.ledger.reconcile()["problems"],
+    }
+
+
+def passed(report):
+    return report["conserved"] and not report["negative_accounts"] and not report["ledger_problems"]
+
+
+def print_report(report, out=sys.stdout):
+    all_latencies = sorted(v for values in report["latencies"].values() for v in values)
+    count = len(all_latencies)
+    elapsed = report["elapsed"]
+    print(f"{count} operations in {elapsed:.2f}s, {count / elapsed if elapsed else 0:.0f} ops/s, "
+          f"{report['errors']} errors", file=out)
+    print(f"{'operation':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", file=out)
+    rows = sorted(report["latencies"].items()) + [("all", all_latencies)]
+    for name, values in rows:
+        print(f"{name:<16}{len(values):>8}" +
+              "".join(f"{percentile(values, pct) * 1000:>10.2f}" for pct in (50, 95, 99)), file=out)
+    status = "OK" if passed(report) else "FAILED"
+    print(f"Money conservation {status}: opening ${format_cents(report['opening_total'])}, "
+          f"expected ${format_cents(report['expected_total'])}, closing ${format_cents(report['closing_total'])}, "
+          f"{len(report['negative_accounts'])} negative balances, "
+          f"{len(report['ledger_problems'])} ledger problems", file=out)
+    for problem in report["ledger_problems"][:20]:
+        print(f"  {problem}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent ATM kiosk sessions and report latency.")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent kiosk sessions (threads)")
+    parser.add_argument("--ops", type=int, default=200, help="operations per session after login")
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--initial-balance", type=float, default=1000.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", nargs="?", const=DEFAULT_MONGO_URI,
+                        help=f"run against mongod (default {DEFAULT_MONGO_URI}) instead of the in-process stand-in; "
+                             f"the '{LOADTEST_DB}' database is dropped first")
+    args = parser.parse_args(argv)
+
+    if args.mongo_uri:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo_uri)
+        client.drop_database(LOADTEST_DB)
+        db = client[LOADTEST_DB] # Indexes come from engine.prepare(), like any kiosk's
+    else:
+        db = InMemoryDatabase()
+
+    report = run_load_test(db, args.sessions, args.ops, args.accounts,
+                           args.initial_balance, seed=args.seed)
+    print_report(report)
+    return 0 if passed(report) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import hashlib
+import hmac
+import os
+import sqlite3
+import threading
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+from pymongo.errors import PyMongoError
+
+from atm_ledger import format_cents
+
+OUTBOX_FILE = "atm_outbox.db"
+SYNC_BATCH_SIZE = 100
+OFFLINE_PIN_ATTEMPTS = 3 # Wrong offline PINs before the card is refused until its next online login
+
+PENDING = "pending"
+SYNCED = "synced"
+REJECTED = "rejected" # The server refused the replay; kept for an operator to resolve
+
+OutboxEntry = namedtuple("OutboxEntry", ["id", "key", "op", "card", "cents", "created_at", "receiver"],
+                         defaults=[None])
+
+
+def pin_hash(pin, salt):
+    # Salted scrypt: a 4-digit PIN has only 10^4 values, so each guess against a copied
+    # outbox file must be expensive (about 50 ms and 16 MiB here)
+    return hashlib.scrypt(pin.encode(), salt=salt, n=2 ** 14, r=8, p=1).hex()
+
+
+# --- Durable Offline Outbox ---
+class OfflineOutbox:
+    # SQLite journal on the kiosk's local disk. While the bank is unreachable, deposits and
+    # withdrawals covered by the cached balance are appended here under an idempotency key,
+    # and OutboxSyncer replays them once the server is back. So are transfers that lost the
+    # connection mid-call, whose replay completes or reverses them.
+    def __init__(self, path=OUTBOX_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL") # An acknowledged offline operation survives power loss
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(account_cache)")]
+        if columns and "salt" not in columns:
+            # Cache from before salted PIN hashes; it is rebuilt as cards log in online again
+            self._db.execute("DROP TABLE account_cache")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                op TEXT NOT NULL,
+                card TEXT NOT NULL,
+                cents INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT
+            );
+            CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id);
+            CREATE TABLE IF NOT EXISTS account_cache (
+                card TEXT PRIMARY KEY,
+                salt BLOB NOT NULL,
+                pin_hash TEXT NOT NULL,
+                balance_cents INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                failed_attempts INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        if "receiver" not in [row[1] for row in self._db.execute("PRAGMA table_info(outbox)")]:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN receiver TEXT") # Outbox from before transfers
+
+    @staticmethod
+    def new_key():
+        return uuid.uuid4().hex
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # --- Cached account state, refreshed whenever the kiosk is online ---
+    def cache_account(self, card, pin, balance_cents, applied_keys=()):
+        # balance_cents is the server's balance, which already includes the pending entries listed
+        # in applied_keys; those are marked synced in the same transaction so they don't count twice
+        salt = os.urandom(16)
+        hashed = pin_hash(pin, salt)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("INSERT OR REPLACE INTO account_cache VALUES (?, ?, ?, ?, ?, 0)",
+                                 (card, salt, hashed, balance_cents, datetime.now().isoformat(" ", "seconds")))
+                self._db.executemany("UPDATE outbox SET status = ?, result = 'Already applied' "
+                                     "WHERE idempotency_key = ? AND status = ?",
+                                     [(SYNCED, key, PENDING) for key in applied_keys])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def update_cached_pin(self, card, pin):
+        salt = os.urandom(16)
+        self._execute("UPDATE account_cache SET salt = ?, pin_hash = ?, failed_attempts = 0 WHERE card = ?",
+                      (salt, pin_hash(pin, salt), card))
+
+    def adjust_cached_balance(self, card, cents):
+        self._execute("UPDATE account_cache SET balance_cents = balance_cents + ? WHERE card = ?", (cents, card))
+
+    def authenticate(self, card, pin):
+        rows = self._execute("SELECT salt, pin_hash, failed_attempts FROM account_cache WHERE card = ?", (card,))
+        if not rows or rows[0][2] >= OFFLINE_PIN_ATTEMPTS:
+            return False
+        salt, expected, _ = rows[0]
+        if hmac.compare_digest(pin_hash(pin, salt), expected):
+            self._execute("UPDATE account_cache SET failed_attempts = 0 WHERE card = ?", (card,))
+            return True
+        self._execute("UPDATE account_cache SET failed_attempts = failed_attempts + 1 WHERE card = ?", (card,))
+        return False
+
+    def _pending_totals(self, card):
+        rows = self._execute("SELECT op, COALESCE(SUM(cents), 0) FROM outbox "
+                             "WHERE card = ? AND status = ? GROUP BY op", (card, PENDING))
+        return dict(rows)
+
+    def cached_balance(self, card):
+        # Last balance confirmed by the server plus everything still waiting to sync
+        rows = self._execute("SELECT balance_cents, updated_at FROM account_cache WHERE card = ?", (card,))
+        if not rows:
+            return None, None
+        pending = self._pending_totals(card)
+        return (rows[0][0] + pending.get("deposit", 0) - pending.get("withdraw", 0) - pending.get("transfer", 0),
+                rows[0][1])
+
+    # --- Journal ---
+    def _insert(self, op, card, cents, key, receiver=None):
+        # Caller holds self._lock; a key recorded twice (e.g. a retried fallback) is stored once
+        self._db.execute("INSERT OR IGNORE INTO outbox (idempotency_key, op, card, cents, created_at, receiver) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, op, card, cents, datetime.now().isoformat(" ", "seconds"), receiver))
+
+    def record(self, op, card, cents, key, receiver=None):
+        with self._lock:
+            self._insert(op, card, cents, key, receiver)
+
+    def deposit(self, card, cents, key):
+        self.record("deposit", card, cents, key)
+        return f"Deposited ${format_cents(cents)} (offline, will sync)"
+
+    def withdraw(self, card, cents, key):
+        # Limited by the server-confirmed balance minus pending withdrawals; offline deposits don't count.
+        # The check and the insert share one lock, so two offline withdrawals can't both pass it
+        with self._lock:
+            rows = self._db.execute("SELECT balance_cents FROM account_cache WHERE card = ?", (card,)).fetchall()
+            pending = self._db.execute("SELECT COALESCE(SUM(cents), 0) FROM outbox WHERE card = ? "
+                                       "AND op IN ('withdraw', 'transfer') AND status = ?", (card, PENDING)).fetchone()[0]
+            if not rows or rows[0][0] - pending < cents:
+                return None
+            self._insert("withdraw", card, cents, key)
+        return f"Withdrawn ${format_cents(cents)} (offline, will sync)"
+
+    def transfer(self, card, receiver, cents, key):
+        # Only for a transfer interrupted mid-call: it may be half-posted, and replaying its key
+        # completes it, or reports it refused once the ledger has reversed it
+        self.record("transfer", card, cents, key, receiver)
+        return (f"Connection lost: the transfer of ${format_cents(cents)} to {receiver} "
+                f"will be completed or reversed when the bank is reachable")
+
+    def pending(self, limit=SYNC_BATCH_SIZE):
+        rows = self._execute("SELECT id, idempotency_key, op, card, cents, created_at, receiver FROM outbox "
+                             "WHERE status = ? ORDER BY id LIMIT ?", (PENDING, limit))
+        return [OutboxEntry(*row) for row in rows]
+
+    def pending_keys(self, card):
+        return [row[0] for row in self._execute("SELECT idempotency_key FROM outbox WHERE card = ? AND status = ?",
+                                                (card, PENDING))]
+
+    def pending_count(self):
+        return self._execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (PENDING,))[0][0]
+
+    def mark(self, outcomes, balances=None):
+        # outcomes: [(entry, status, message)]; balances: {card: server balance read after the replay}.
+        # Committed together with the cache update. The server balance is authoritative; adding each
+        # synced delta is only the fallback when it couldn't be read, because an entry the server
+        # had already applied may be in the cached balance already.
+        balances = balances or {}
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for entry, status, message in outcomes:
+                    self._db.execute("UPDATE outbox SET status = ?, result = ? WHERE id = ?", (status, message, entry.id))
+                    if status != SYNCED:
+                        continue
+                    deltas = [(entry.card, entry.cents if entry.op == "deposit" else -entry.cents)]
+                    if entry.op == "transfer":
+                        deltas.append((entry.receiver, entry.cents))
+                    self._db.executemany("UPDATE account_cache SET balance_cents = balance_cents + ? WHERE card = ?",
+                                         [(delta, card) for card, delta in deltas if card not in balances])
+                self._db.executemany("UPDATE account_cache SET balance_cents = ? WHERE card = ?",
+                                     [(cents, card) for card, cents in balances.items()])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# --- Background Syncer ---
+class OutboxSyncer:
+    # Replays pending outbox entries in batches whenever the connection manager reports the
+    # server reachable. Keys already in the journal are skipped, so a crash mid-batch is harmless.
+    def __init__(self, outbox, engine, connection, batch_size=SYNC_BATCH_SIZE, interval=2.0):
+        self.outbox = outbox
+        self.engine = engine
+        self.connection = connection
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.connection.available:
+                try:
+                    while self.sync_once() == self.batch_size and not self._stop.is_set():
+                        pass
+                except PyMongoError as e:
+                    self.connection.mark_offline(e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh_account(self, card, pin):
+        # Online login: cache the server's balance. Keys are read before the balance, so an entry
+        # the syncer applies in between stays pending until mark() overwrites the balance again.
+        applied = self.engine.ledger.applied_keys(self.outbox.pending_keys(card))
+        self.outbox.cache_account(card, pin, self.engine.balance(card).data, applied)
+
+    def _server_balances(self, cards):
+        balances = {}
+        try:
+            for card in cards:
+                cents = self.engine.balance(card).data
+                if cents is not None:
+                    balances[card] = cents
+        except PyMongoError:
+            pass # Cards left out fall back to adding their deltas in mark()
+        return balances
+
+    def sync_once(self):
+        entries = self.outbox.pending(self.batch_size)
+        if not entries:
+            return 0
+        applied = self.engine.ledger.applied_keys([entry.key for entry in entries])
+        outcomes = []
+        try:
+            for entry in entries:
+                if entry.key in applied:
+                    outcomes.append((entry, SYNCED, "Already applied"))
+                    continue
+                if entry.op == "deposit":
+                    result = self.engine.deposit(entry.card, format_cents(entry.cents), idempotency_key=entry.key)
+                elif entry.op == "transfer":
+                    # No cash moved, so unlike a withdrawal the funds check still applies
+                    result = self.engine.transfer(entry.card, entry.receiver, format_cents(entry.cents),
+                                                  idempotency_key=entry.key)
+                else:
+                    # The cash is already out of the machine, so the ledger must record it even if it overdraws
+                    result = self.engine.withdraw(entry.card, format_cents(entry.cents), idempotency_key=entry.key,
+                                                  allow_overdraft=True)
+                outcomes.append((entry, SYNCED if result.ok else REJECTED, result.message))
+        finally:
+            # Whatever reached the server is marked even if a later entry in the batch failed
+            if outcomes:
+                synced_cards = {card for entry, status, _ in outcomes if status == SYNCED
+                                for card in (entry.card, entry.receiver) if card}
+                self.outbox.mark(outcomes, self._server_balances(synced_cards))
+        return len(entries)
@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.fixture
+def engine():
+    # Fresh in-memory database with cards A and B holding $100.00 each
+    mongomock = pytest.importorskip("mongomock")
+    from atm_engine import ATMEngine
+
+    engine = ATMEngine(mongomock.MongoClient()["atm_test"])
+    engine.prepare()
+    for card in ("A", "B"):
+        engine.create_account(card, "1234")
+        engine.deposit(card, "100")
+    return engine
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from atm_connection import MongoConnectionManager, ONLINE, OFFLINE, STARTING
+
+
+class FakeClient:
+    # Answers ping while `up`; otherwise fails the way an unreachable server does.
+    # Clearing `gate` holds every ping until it is set again.
+    def __init__(self):
+        self.up = False
+        self.gate = threading.Event()
+        self.gate.set()
+
+    @property
+    def admin(self):
+        return self
+
+    def command(self, name):
+        self.gate.wait(5)
+        if not self.up:
+            raise AutoReconnect("server down")
+        return {"ok": 1}
+
+    def close(self):
+        pass
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached in time")
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def manager():
+    manager = MongoConnectionManager(health_interval=0.01, offline_retry_interval=0.01)
+    manager._client = FakeClient()
+    yield manager
+    manager.close()
+
+
+def test_starting_offline_starting_online(manager):
+    calls = []
+    release = threading.Event()
+
+    def warm_up():
+        calls.append(manager.state)
+        if len(calls) == 1:
+            raise RuntimeError("bad legacy data") # Logged and retried on the next probe
+        release.wait(5)
+
+    manager._client.gate.clear()
+    manager.start(on_connect=warm_up)
+    assert manager.state == STARTING and not manager.available
+    manager._client.gate.set()
+    wait_for(lambda: manager.state == OFFLINE)
+    assert calls == []
+
+    manager._client.up = True
+    wait_for(lambda: len(calls) == 2)
+    assert calls == [STARTING, STARTING]
+    assert manager.state == STARTING and not manager.available and not manager.warmed_up
+
+    release.set()
+    wait_for(lambda: manager.state == ONLINE)
+    assert manager.warmed_up and manager.available
+    assert isinstance(manager.last_error, RuntimeError)
+
+
+def test_outage_after_warm_up_recovers_without_warming_up_again(manager):
+    calls = []
+    manager._client.up = True
+    manager.start(on_connect=lambda: calls.append(1))
+    wait_for(lambda: manager.state == ONLINE)
+
+    manager._client.up = False
+    manager.mark_offline(AutoReconnect("query failed"))
+    assert not manager.available
+    manager._client.up = True
+    wait_for(lambda: manager.state == ONLINE)
+    assert calls == [1]
+
+
+def test_from_env_reads_every_interval_and_timeout():
+    manager = MongoConnectionManager.from_env({
+        "ATM_MONGO_DB": "kiosk",
+        "ATM_MONGO_OFFLINE_RETRY_INTERVAL": "0.5",
+        "ATM_MONGO_HEALTH_INTERVAL": "7",
+        "ATM_MONGO_UI_TIMEOUT_MS": "1500",
+        "ATM_MONGO_SOCKET_TIMEOUT_MS": "",
+    })
+    assert manager.db_name == "kiosk"
+    assert manager.offline_retry_interval == 0.5
+    assert manager.health_interval == 7.0
+    assert manager.ui_timeout_ms == 1500
+    assert manager.socket_timeout_ms == MongoConnectionManager().socket_timeout_ms
@@ -0,0 +1,199 @@
+import io
+import json
+from datetime import timedelta
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+mongomock = pytest.importorskip("mongomock")
+
+import atm_engine
+from atm_engine import ATMEngine, _BatchState
+from atm_ledger import SNAPSHOT_EVERY, SUSPENSE_ACCOUNT, INTENT_PENDING, to_cents
+
+
+def account(engine, card):
+    return engine.accounts.find_one({"card": card})
+
+
+def test_transfer_moves_cents_and_reconciles(engine):
+    assert engine.transfer("A", "B", "12.34").ok
+    assert engine.balance("A").data == 8766
+    assert engine.balance("B").data == 11234
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_withdraw_refuses_overdraft(engine):
+    assert not engine.withdraw("A", "100.01").ok
+    assert account(engine, "A")["balance_cents"] == 10000
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_failed_leg_is_parked_in_suspense_and_reversed(engine):
+    assert engine.ledger.post("transfer", [("A", -500, "out"), ("MISSING", 500, "in")]) is None
+    assert engine.balance("A").data == 10000
+    kinds = [entry["kind"] for entry in engine.ledger.journal.find({"legs.account": SUSPENSE_ACCOUNT})]
+    assert kinds == ["transfer_failed", "transfer_reversal"]
+    report = engine.ledger.reconcile()
+    assert report["problems"] == []
+    assert report["system_totals"][SUSPENSE_ACCOUNT] == 0
+
+
+def interrupted_transfer(engine, monkeypatch, target, name, calls_before_drop):
+    # Simulates the kiosk losing the server part-way through engine.transfer("A", "B", "5")
+    original = getattr(target, name)
+    calls = []
+
+    def flaky(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > calls_before_drop:
+            raise AutoReconnect("connection dropped")
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(target, name, flaky)
+    with pytest.raises(AutoReconnect):
+        engine.transfer("A", "B", "5")
+    monkeypatch.undo()
+
+
+def test_transfer_dropped_mid_way_is_reversed_by_repair(engine, monkeypatch):
+    interrupted_transfer(engine, monkeypatch, engine.ledger, "_claim_seq", 1)
+    assert account(engine, "A")["balance_cents"] == 9500
+    assert engine.statement_page("A").data["lines"][-1].endswith("Deposited: $100.00") # Pending isn't shown
+    assert engine.ledger.repair_incomplete() == 0 # Still within the grace period
+    assert engine.ledger.repair_incomplete(grace=timedelta(0)) == 1
+    assert engine.balance("A").data == 10000
+    assert engine.balance("B").data == 10000
+    assert engine.ledger.journal.count_documents({"state": INTENT_PENDING}) == 0
+    report = engine.ledger.reconcile()
+    assert report["problems"] == []
+    assert report["system_totals"][SUSPENSE_ACCOUNT] == 0
+
+
+def test_transfer_dropped_after_every_claim_is_completed_by_repair(engine, monkeypatch):
+    interrupted_transfer(engine, monkeypatch, engine.ledger.journal, "update_one", 0)
+    assert engine.ledger.repair_incomplete(grace=timedelta(0)) == 1
+    assert engine.balance("A").data == 9500
+    assert engine.balance("B").data == 10500
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_snapshot_taken_every_n_postings(engine):
+    for _ in range(SNAPSHOT_EVERY):
+        engine.deposit("A", "1")
+    snapshot = engine.ledger.latest_snapshot("A")
+    assert snapshot["seq"] == SNAPSHOT_EVERY
+    assert engine.balance("A").data == 10000 + SNAPSHOT_EVERY * 100
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_reconcile_flags_balance_drift(engine):
+    engine.accounts.update_one({"card": "A"}, {"$inc": {"balance_cents": 1}})
+    assert any(problem.startswith("A: ledger total") for problem in engine.ledger.reconcile()["problems"])
+
+
+def test_system_account_names_are_not_cards(engine):
+    assert not engine.create_account("@cash", "1234").ok
+    engine.accounts.insert_one({"card": "@cash", "pin": "1234", "balance_cents": 0, "ledger_seq": 0})
+    assert not engine.authenticate("@cash", "1234").ok
+    assert not engine.withdraw("@cash", "50").ok
+    assert not engine.transfer("@cash", "A", "10").ok
+    assert not engine.transfer("A", "@cash", "10").ok
+    assert engine.balance("A").data == 10000
+
+
+def test_posting_to_legacy_account_migrates_it_first():
+    engine = ATMEngine(mongomock.MongoClient()["atm_test"])
+    engine.accounts.insert_one({"card": "L", "pin": "1234", "balance": 50.0, "transactions": []})
+    assert engine.deposit("L", "5").ok
+    engine.prepare()
+    assert engine.balance("L").data == 5500
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_card_index_is_made_unique_and_duplicates_stop_prepare():
+    db = mongomock.MongoClient()["atm_test"]
+    db["accounts"].create_index("card")
+    ATMEngine(db).prepare()
+    assert db["accounts"].index_information()["card_1"]["unique"]
+
+    db = mongomock.MongoClient()["atm_test"]
+    db["accounts"].insert_many([{"card": "D", "pin": "1234", "balance_cents": 0, "ledger_seq": 0} for _ in range(2)])
+    with pytest.raises(RuntimeError, match="'D'"):
+        ATMEngine(db).prepare()
+
+
+def test_create_account_loses_a_race_cleanly(engine, monkeypatch):
+    monkeypatch.setattr(engine.accounts, "find_one", lambda *args, **kwargs: None) # Check passes, insert refuses
+    assert not engine.create_account("A", "1234").ok
+    assert engine.accounts.count_documents({"card": "A"}) == 1
+
+
+def test_amounts_are_bounded(engine):
+    with pytest.raises(ValueError):
+        to_cents("1e20")
+    assert engine.deposit("A", "1e20").message == "Invalid amount"
+    assert account(engine, "A")["balance_cents"] == 10000
+
+
+def run_batch(engine, ops, source=None):
+    out = io.StringIO()
+    totals = engine.run_batch(io.StringIO("".join(json.dumps(op) + "\n" for op in ops)), out, source=source)
+    return totals, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_batch_applies_ops_and_reports_bad_lines(engine):
+    totals, results = run_batch(engine, [
+        {"op": "create_account", "card": "N", "pin": "1111"},
+        {"op": "deposit", "card": "N", "amount": 20},
+        {"op": "transfer", "card": "N", "receiver": "A", "amount": 5},
+        {"op": "withdraw", "card": "N", "amount": 100},
+        {"op": "deposit", "card": "A", "amount": "1e20"},
+    ])
+    assert totals == {"ops": 5, "ok": 3, "failed": 2}
+    assert [result["ok"] for result in results] == [True, True, True, False, False]
+    assert engine.balance("N").data == 1500
+    assert engine.balance("A").data == 10500
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_batch_conflict_is_undone_before_the_journal(engine, monkeypatch):
+    account_requests = _BatchState.account_requests
+
+    def racing(batch):
+        engine.deposit("B", "1") # Another kiosk writes between prefetch and write-back
+        return account_requests(batch)
+
+    monkeypatch.setattr(_BatchState, "account_requests", racing)
+    totals, results = run_batch(engine, [{"op": "transfer", "card": "A", "receiver": "B", "amount": 10}])
+    assert totals["failed"] == 1
+    assert engine.balance("A").data == 10000
+    assert engine.balance("B").data == 10000 + atm_engine.BATCH_CONFLICT_RETRIES * 100
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_rerunning_a_batch_file_applies_it_once(engine):
+    ops = [{"op": "deposit", "card": "A", "amount": 5},
+           {"op": "withdraw", "card": "B", "amount": 5, "id": "w-1"}]
+    run_batch(engine, ops, source="f1")
+    totals, results = run_batch(engine, ops, source="f1")
+    assert totals["ok"] == 2
+    assert [result["message"] for result in results] == ["Already applied", "Already applied"]
+    assert engine.balance("A").data == 10500
+    assert engine.balance("B").data == 9500
+    totals, results = run_batch(engine, [{"op": "deposit", "card": "A", "amount": 1, "id": "d-1"}] * 2)
+    assert [result["ok"] for result in results] == [True, False]
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_batch_account_writes_are_undone_if_the_journal_insert_fails(engine, monkeypatch):
+    def fail(requests, *args, **kwargs):
+        raise mongomock.BulkWriteError({"writeErrors": [{"code": 2, "errmsg": "journal lost"}]})
+
+    monkeypatch.setattr(engine.ledger.journal, "bulk_write", fail)
+    with pytest.raises(mongomock.BulkWriteError):
+        run_batch(engine, [{"op": "transfer", "card": "A", "receiver": "B", "amount": 10}])
+    monkeypatch.undo()
+    assert account(engine, "A")["balance_cents"] == 10000
+    assert account(engine, "B")["ledger_seq"] == 1
+    assert engine.ledger.reconcile()["problems"] == []
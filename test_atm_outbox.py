@@ -0,0 +1,168 @@
+import sqlite3
+from datetime import timedelta
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+mongomock = pytest.importorskip("mongomock")
+
+from atm_outbox import OfflineOutbox, OutboxSyncer, OFFLINE_PIN_ATTEMPTS, REJECTED
+
+
+class OnlineConnection:
+    available = True
+
+    def mark_offline(self, error=None):
+        self.available = False
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = OfflineOutbox(str(tmp_path / "outbox.db"))
+    yield outbox
+    outbox.close()
+
+
+@pytest.fixture
+def syncer(outbox, engine):
+    syncer = OutboxSyncer(outbox, engine, OnlineConnection())
+    syncer.refresh_account("A", "1234")
+    return syncer
+
+
+def test_replayed_key_after_interrupted_posting_charges_once(engine, monkeypatch):
+    update_one = engine.ledger.journal.update_one
+    calls = []
+
+    def fail_first(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise mongomock.WriteError("completion lost") # The claim landed, the intent stays pending
+        return update_one(*args, **kwargs)
+
+    monkeypatch.setattr(engine.ledger.journal, "update_one", fail_first)
+    with pytest.raises(mongomock.WriteError):
+        engine.withdraw("A", "10", idempotency_key="k1")
+    assert engine.ledger.applied_keys(["k1"]) == set()
+    assert engine.withdraw("A", "10", idempotency_key="k1").ok
+    assert engine.withdraw("A", "10", idempotency_key="k1").ok
+    assert engine.accounts.find_one({"card": "A"})["balance_cents"] == 9000
+    assert engine.ledger.applied_keys(["k1"]) == {"k1"}
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_sync_replays_offline_entries_once(engine, outbox, syncer):
+    outbox.deposit("A", 500, "d1")
+    assert outbox.withdraw("A", 2000, "w1")
+    assert outbox.cached_balance("A")[0] == 8500
+    assert syncer.sync_once() == 2
+    assert syncer.sync_once() == 0
+    assert engine.balance("A").data == 8500
+    assert outbox.cached_balance("A")[0] == 8500
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_offline_withdrawal_is_replayed_even_if_it_overdraws(engine, outbox, syncer):
+    assert outbox.withdraw("A", 6000, "w1")
+    engine.withdraw("A", "60") # Spent online at another kiosk meanwhile
+    syncer.sync_once()
+    assert engine.balance("A").data == -2000
+    assert outbox.pending_count() == 0
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_entry_already_applied_is_not_counted_twice(engine, outbox, syncer):
+    # The server applied the withdrawal, but the kiosk lost the reply and journaled it offline
+    engine.withdraw("A", "10", idempotency_key="k1")
+    outbox.withdraw("A", 1000, "k1")
+    syncer.refresh_account("A", "1234") # Card logs in online before the syncer runs
+    assert outbox.cached_balance("A")[0] == 9000
+    syncer.sync_once()
+    assert outbox.cached_balance("A")[0] == 9000
+    assert engine.balance("A").data == 9000
+
+
+def interrupt_transfer(engine, outbox, monkeypatch, key):
+    # The kiosk loses the server after the transfer's claims, before its journal entry is completed
+    def drop(*args, **kwargs):
+        raise AutoReconnect("connection dropped")
+
+    monkeypatch.setattr(engine.ledger.journal, "update_one", drop)
+    with pytest.raises(AutoReconnect):
+        engine.transfer("A", "B", "25", idempotency_key=key)
+    monkeypatch.undo()
+    outbox.transfer("A", "B", 2500, key)
+
+
+def test_interrupted_transfer_is_completed_once_by_the_syncer(engine, outbox, syncer, monkeypatch):
+    syncer.refresh_account("B", "1234")
+    interrupt_transfer(engine, outbox, monkeypatch, "t1")
+    assert outbox.cached_balance("A")[0] == 7500
+    assert not outbox.withdraw("A", 8000, "w1") # The pending transfer counts against offline cash
+    assert syncer.sync_once() == 1
+    assert syncer.sync_once() == 0
+    assert engine.balance("A").data == 7500
+    assert engine.balance("B").data == 12500
+    assert outbox.cached_balance("A")[0] == 7500
+    assert outbox.cached_balance("B")[0] == 12500
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_interrupted_transfer_reversed_by_repair_is_rejected_on_replay(engine, outbox, syncer, monkeypatch):
+    calls = []
+    claim_seq = engine.ledger._claim_seq
+
+    def drop_second(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise AutoReconnect("connection dropped") # Sender debited, receiver not yet credited
+        return claim_seq(*args)
+
+    monkeypatch.setattr(engine.ledger, "_claim_seq", drop_second)
+    with pytest.raises(AutoReconnect):
+        engine.transfer("A", "B", "25", idempotency_key="t1")
+    monkeypatch.undo()
+    outbox.transfer("A", "B", 2500, "t1")
+    engine.ledger.repair_incomplete(grace=timedelta(0))
+    syncer.sync_once()
+    rows = outbox._execute("SELECT status FROM outbox WHERE idempotency_key = 't1'")
+    assert rows[0][0] == REJECTED
+    assert outbox.cached_balance("A")[0] == 10000
+    assert engine.balance("A").data == 10000
+    assert engine.ledger.reconcile()["problems"] == []
+
+
+def test_outbox_from_before_transfers_gains_the_receiver_column(tmp_path):
+    path = str(tmp_path / "old.db")
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT NOT NULL UNIQUE, "
+                "op TEXT NOT NULL, card TEXT NOT NULL, cents INTEGER NOT NULL, created_at TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', result TEXT)")
+    old.execute("INSERT INTO outbox (idempotency_key, op, card, cents, created_at) VALUES ('d1', 'deposit', 'A', 5, '')")
+    old.commit()
+    old.close()
+    outbox = OfflineOutbox(path)
+    outbox.transfer("A", "B", 100, "t1")
+    assert [(entry.op, entry.receiver) for entry in outbox.pending()] == [("deposit", None), ("transfer", "B")]
+    outbox.close()
+
+
+def test_rejected_entry_is_kept_for_an_operator(engine, outbox, syncer):
+    outbox.deposit("GONE", 500, "d1")
+    syncer.sync_once()
+    rows = outbox._execute("SELECT status FROM outbox WHERE idempotency_key = 'd1'")
+    assert rows[0][0] == REJECTED
+
+
+def test_offline_pin_is_salted_and_locks_after_failed_attempts(outbox, syncer):
+    (salt_a, hash_a), = outbox._execute("SELECT salt, pin_hash FROM account_cache WHERE card = 'A'")
+    outbox.cache_account("B", "1234", 0)
+    (salt_b, hash_b), = outbox._execute("SELECT salt, pin_hash FROM account_cache WHERE card = 'B'")
+    assert salt_a != salt_b and hash_a != hash_b
+
+    assert outbox.authenticate("A", "1234")
+    for _ in range(OFFLINE_PIN_ATTEMPTS):
+        assert not outbox.authenticate("A", "0000")
+    assert not outbox.authenticate("A", "1234")
+    syncer.refresh_account("A", "1234") # Next online login unlocks it
+    assert outbox.authenticate("A", "1234")
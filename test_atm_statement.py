@@ -0,0 +1,89 @@
+import io
+from datetime import datetime
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from atm_engine import ATMEngine, parse_date_range
+
+
+def all_pages(engine, card, page_size, start=None, end=None):
+    pages, after = [], None
+    while True:
+        page = engine.statement_page(card, start, end, after=after, page_size=page_size).data
+        pages.append(page["lines"])
+        after = page["next"]
+        if after is None:
+            return pages
+
+
+@pytest.fixture
+def legacy_engine():
+    # Card L predates the ledger: a float balance and free-text history, migrated by prepare()
+    engine = ATMEngine(mongomock.MongoClient()["atm_test"])
+    engine.accounts.insert_one({"card": "L", "pin": "1234", "balance": 30.0, "transactions": [
+        "2020-01-05 10:00:00 - Deposited: $50.00",
+        "2020-02-05 10:00:00 - Withdrawn: $20.00",
+        "2021-03-01 09:30:00 - Deposited: $0.00",
+    ]})
+    engine.prepare()
+    for amount in ("1", "2", "3"):
+        engine.deposit("L", amount)
+    return engine
+
+
+def test_keyset_pages_cover_every_leg_once(engine):
+    for cents in range(1, 12):
+        engine.deposit("A", f"0.{cents:02d}")
+    pages = all_pages(engine, "A", page_size=5)
+    assert [len(lines) for lines in pages] == [5, 5, 2]
+    lines = [line for lines in pages for line in lines]
+    assert lines[0].endswith("Deposited: $100.00")
+    assert lines[-1].endswith("Deposited: $0.11")
+    assert len(set(lines)) == len(lines)
+
+
+def test_legacy_history_is_paged_before_the_ledger(legacy_engine):
+    lines = [line for lines in all_pages(legacy_engine, "L", page_size=2) for line in lines]
+    assert len(lines) == 3 + 4 # Legacy lines, the opening balance and three deposits
+    assert lines[0] == "2020-01-05 10:00:00      (legacy)  Deposited: $50.00"
+    assert lines[3].endswith("Opening balance carried over")
+    assert legacy_engine.mini_statement("L", count=7).data[0].startswith("2020-01-05")
+
+
+def test_legacy_history_respects_the_date_range(legacy_engine):
+    start, end = parse_date_range("2020-02-01", "2020-12-31")
+    assert legacy_engine.statement_page("L", start, end).data["lines"] == [
+        "2020-02-05 10:00:00      (legacy)  Withdrawn: $20.00"]
+
+
+def test_export_totals_and_legacy_section(legacy_engine):
+    legacy_engine.withdraw("L", "0.50")
+    out = io.StringIO()
+    result = legacy_engine.export_statement("L", out)
+    assert result.ok and result.data == 3 + 5
+    text = out.getvalue()
+    assert "History from before the ledger" in text
+    assert "Entries: 5  Credits: $36.00  Debits: $0.50  Net: $35.50" in text
+    assert "Pre-ledger history lines: 3 (not included in the totals)" in text
+    assert legacy_engine.balance("L").data == 3550
+
+
+def test_export_of_an_empty_range(engine):
+    out = io.StringIO()
+    start, end = parse_date_range("2000-01-01", "2000-01-31")
+    assert engine.export_statement("A", out, start, end).data == 0
+    assert "Period: 2000-01-01 to 2000-01-31" in out.getvalue()
+    assert "Entries: 0  Credits: $0.00  Debits: $0.00  Net: $0.00" in out.getvalue()
+    assert not engine.export_statement("NOPE", io.StringIO()).ok
+
+
+def test_parse_date_range():
+    assert parse_date_range("", "  ") == (None, None)
+    assert parse_date_range("2024-02-28", "2024-02-29") == (datetime(2024, 2, 28), datetime(2024, 3, 1))
+    assert parse_date_range(" 2024-01-01 ", "") == (datetime(2024, 1, 1), None)
+    assert parse_date_range("2024-01-01", "2024-01-01") == (datetime(2024, 1, 1), datetime(2024, 1, 2))
+    for start, end in [("2024-01-02", "2024-01-01"), ("2024-13-01", ""), ("", "01/02/2024")]:
+        with pytest.raises(ValueError):
+            parse_date_range(start, end)